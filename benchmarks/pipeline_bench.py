@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+端到端吞吐基准，不需要访问外网
+在子进程中启动一个本地 aiohttp 服务，模拟解析接口（返回 type/downurl/pics/audio_*_url）和媒体 CDN，
+可以调节延迟、带宽、错误率以及是否支持 Range，然后让 Down 和 DouyinDownloader 完整跑一遍，
+输出 items/s、MB/s、单个作品下载耗时的 p50/p99 以及峰值内存
+用法：
+    python benchmarks/pipeline_bench.py --items 200 --size 1048576 --latency 0.05 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root not in sys.path:
+    sys.path.insert(0, root)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# ---------------------------------------------------------------- 本地模拟服务
+
+def serve(port, args, ready):
+    from aiohttp import web
+
+    payload = os.urandom(args.size)
+    chunk = 64 * 1024
+
+    def should_fail():
+        return random.random() < args.error_rate
+
+    async def query(request):
+        await asyncio.sleep(args.resolver_latency)
+        if should_fail():
+            return web.Response(status=503)
+        # 输入链接形如 bench://video/1、bench://gallery/2、bench://audio/3
+        kind, idx = request.query["url"].split("//", 1)[1].split("/")
+        base = "http://127.0.0.1:{}/media".format(port)
+        data = {"title": "bench {} {}".format(kind, idx), "type": 1, "downurl": "", "pics": [],
+                "audio_32k_url": "", "audio_64k_url": "", "audio_128k_url": ""}
+        if kind == "video":
+            data["downurl"] = "{}/{}_{}.mp4".format(base, kind, idx)
+        elif kind == "gallery":
+            data["type"] = 2
+            data["pics"] = ["{}/{}_{}_{}.png".format(base, kind, idx, i) for i in range(args.pics)]
+        else:
+            data["audio_32k_url"] = "{}/{}_{}.mp3".format(base, kind, idx)
+        return web.json_response({"code": 200, "data": data})
+
+    async def media(request):
+        await asyncio.sleep(args.latency)
+        if should_fail():
+            return web.Response(status=503)
+        headers = {"ETag": '"bench"'}
+        if not args.no_range:
+            headers["Accept-Ranges"] = "bytes"
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(payload))
+            return web.Response(headers=headers)
+
+        start, end, status = 0, len(payload) - 1, 200
+        rng = request.headers.get("Range")
+        if rng and not args.no_range:
+            a, b = rng.split("=", 1)[1].split("-")
+            start, end, status = int(a), int(b) if b else len(payload) - 1, 206
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, len(payload))
+        headers["Content-Length"] = str(end - start + 1)
+
+        resp = web.StreamResponse(status=status, headers=headers)
+        await resp.prepare(request)
+        for pos in range(start, end + 1, chunk):
+            block = payload[pos:min(pos + chunk, end + 1)]
+            await resp.write(block)
+            if args.bandwidth:
+                await asyncio.sleep(len(block) / args.bandwidth)
+        return resp
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/query", query)
+        app.router.add_route("*", "/media/{name}", media)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ---------------------------------------------------------------- 基准
+
+def configure(port, workdir):
+    from utils.utils import Utils
+
+    config = Utils.read_config(filepath=("config",), filename="config.ini")
+    config.set("download_info", "filepath", os.path.join(workdir, "download"))
+    config.set("resolver", "url", "http://127.0.0.1:{}/query".format(port))
+    config.set("resolver", "rate", "100000")
+    config.set("resolver", "burst", "1000")
+    config.set("cache", "filepath", os.path.join(workdir, "resolver.sqlite3"))
+    config.set("cache", "bypass", "true")
+    # 任务清单和去重索引也放在临时目录，每次基准都从零开始
+    config.set("manifest", "filepath", os.path.join(workdir, "jobs.sqlite3"))
+    config.set("dedup", "filepath", os.path.join(workdir, "dedup.sqlite3"))
+    config.set("retry", "base_delay", "0.05")
+    config.set("metrics", "enabled", "false")
+    return config
+
+
+def timed(cls, latencies):
+    class Timed(cls):
+        async def download_item(self, *args, **kwargs):
+            start = time.perf_counter()
+            ret = await super().download_item(*args, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            return ret
+
+    return Timed
+
+
+def folder_size(path):
+    total = count = 0
+    for dirpath, _, files in os.walk(path):
+        for name in files:
+            if not name.endswith((".part", ".json")):
+                total += os.path.getsize(os.path.join(dirpath, name))
+                count += 1
+    return total, count
+
+
+def run_case(name, cls, urls, runner, workdir, verbose):
+    latencies = []
+    downloader = timed(cls, latencies)()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+        start = time.perf_counter()
+        asyncio.run(runner(downloader, urls))
+        elapsed = time.perf_counter() - start
+    size, files = folder_size(os.path.join(workdir, "download"))
+    shutil.rmtree(os.path.join(workdir, "download"), ignore_errors=True)
+
+    latencies.sort()
+    return {
+        "case": name,
+        "links": len(urls),
+        "files": files,
+        "seconds": round(elapsed, 3),
+        "items_per_second": round(files / elapsed, 2),
+        "mb_per_second": round(size / elapsed / 1024 / 1024, 2),
+        "p50": round(statistics.median(latencies), 4) if latencies else None,
+        "p99": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 4) if latencies else None,
+    }
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是字节
+    return round(rss / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Down / DouyinDownloader 端到端吞吐基准（本地模拟服务）")
+    parser.add_argument("--items", type=int, default=100, help="每个场景的链接数")
+    parser.add_argument("--pics", type=int, default=4, help="图集中的图片数")
+    parser.add_argument("--size", type=int, default=512 * 1024, help="每个媒体文件的字节数")
+    parser.add_argument("--latency", type=float, default=0.02, help="媒体请求的首字节延迟（秒）")
+    parser.add_argument("--resolver-latency", type=float, default=0.02, help="解析接口延迟（秒）")
+    parser.add_argument("--bandwidth", type=float, default=0, help="单个连接的带宽（字节/秒），0 表示不限")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="请求返回 503 的概率")
+    parser.add_argument("--no-range", action="store_true", help="媒体服务不支持 Range")
+    parser.add_argument("--case", choices=("all", "video", "gallery", "audio"), default="all")
+    parser.add_argument("--json", action="store_true", help="以 json 输出结果")
+    parser.add_argument("-v", "--verbose", action="store_true", help="显示下载器自己的输出")
+    args = parser.parse_args()
+
+    port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(port, args, ready), daemon=True)
+    server.start()
+    ready.wait(30)
+
+    from codes.douyin_downloader import DouyinDownloader
+    from codes.dy_ks_request import Down
+
+    async def run_down(downloader, urls):
+        await downloader.client_batch(urls)
+
+    async def run_douyin(downloader, urls):
+        await downloader.client(urls, totals=len(urls))
+
+    cases = [
+        ("video", Down, run_down),
+        ("gallery", Down, run_down),
+        ("audio", DouyinDownloader, run_douyin),
+    ]
+    workdir = tempfile.mkdtemp(prefix="dy_ks_bench_")
+    results = []
+    try:
+        configure(port, workdir)
+        for kind, cls, runner in cases:
+            if args.case not in ("all", kind):
+                continue
+            urls = ["bench://{}/{}".format(kind, i) for i in range(args.items)]
+            results.append(run_case(kind, cls, urls, runner, workdir, args.verbose))
+    finally:
+        server.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    rss = peak_rss_mb()
+    if args.json:
+        print(json.dumps({"results": results, "peak_rss_mb": rss}, ensure_ascii=False, indent=2))
+        return
+    print("{:<8} {:>6} {:>6} {:>8} {:>9} {:>8} {:>8} {:>8}".format(
+        "case", "links", "files", "seconds", "items/s", "MB/s", "p50", "p99"))
+    for r in results:
+        print("{case:<8} {links:>6} {files:>6} {seconds:>8} {items_per_second:>9} {mb_per_second:>8} "
+              "{p50:>8} {p99:>8}".format(**r))
+    print("peak RSS: {} MB".format(rss))
+
+
+if __name__ == '__main__':
+    main()
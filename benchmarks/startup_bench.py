@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+启动耗时基准：对比旧的配置读取方式（traceback + chardet 检测编码）与 UTF-8 快速路径、进程内缓存，
+以及冷启动时导入两个入口模块的耗时（aiohttp 等到真正下载时才导入）与提前导入 aiohttp 的对比
+用法：python benchmarks/startup_bench.py [-n 次数]
+"""
+import argparse
+import configparser
+import os
+import statistics
+import subprocess
+import sys
+import time
+import traceback
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root not in sys.path:
+    sys.path.insert(0, root)
+
+from utils.utils import Utils
+
+CONFIG = os.path.join(root, "config", "config.ini")
+
+
+def legacy_read_config():
+    """旧实现：每次都取调用栈、读文件跑 chardet，再解析"""
+    import chardet
+    traceback.extract_stack()
+    with open(CONFIG, mode="rb") as f:
+        ecod = chardet.detect(f.read()[0:10240])["encoding"]
+    conf = configparser.RawConfigParser()
+    conf.read(CONFIG, encoding=ecod)
+    return conf
+
+
+def fast_read_config():
+    return Utils.read_config(filepath=("config",), filename="config.ini", reload=True)
+
+
+def cached_read_config():
+    return Utils.read_config(filepath=("config",), filename="config.ini")
+
+
+def timeit(func, number):
+    samples = []
+    for _ in range(number):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def cold_start(code, number):
+    """在新进程中执行 code，返回耗时中位数（毫秒）"""
+    samples = []
+    for _ in range(number):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=root, check=True)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="配置加载与导入耗时基准")
+    parser.add_argument("-n", "--number", type=int, default=20, help="每项重复次数")
+    args = parser.parse_args()
+
+    legacy_read_config()  # 预热 chardet 的导入
+    print("读取配置（进程内，中位数）")
+    print("  旧实现 chardet 检测: {:8.3f} ms".format(timeit(legacy_read_config, args.number)))
+    print("  UTF-8 快速路径:      {:8.3f} ms".format(timeit(fast_read_config, args.number)))
+    print("  进程内缓存命中:      {:8.3f} ms".format(timeit(cached_read_config, args.number)))
+
+    number = args.number // 4 or 1
+    print("冷启动（新进程，中位数）")
+    print("  空解释器:                          {:8.1f} ms".format(cold_start("pass", number)))
+    for module in ("codes.dy_ks_request", "codes.douyin_downloader"):
+        print("  import {:<28} {:8.1f} ms".format(module, cold_start("import " + module, number)))
+        print("    提前导入 aiohttp:                {:8.1f} ms".format(cold_start(
+            "import aiohttp, yarl; import " + module, number)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+常驻服务模式：启动一次，会话、解析缓存、目录编号索引和转码池在多次提交之间一直保持，
+通过本机 HTTP 接口提交链接、查询任务状态、订阅完成事件
+    POST /jobs              提交链接：json {"url": ...} / {"urls": [...]}，可带 "kind": "media" | "douyin"；
+                            或者 text/plain，每行一个链接（可以是分享文本），kind 用查询参数指定；
+                            "priority"（或查询参数）为带宽调度的优先级，每高一级分到的带宽翻倍，默认 0
+    GET  /jobs              最近的任务，可用 ?state=queued|running|done|failed 过滤
+    GET  /jobs/{id}         单个任务的状态
+    GET  /events            每完成一个任务推送一行 json（ndjson 流）
+用法：python codes/daemon.py [--host 127.0.0.1] [--port 8686]
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import sys
+import os
+import time
+
+# 添加项目根目录到Python路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+from aiohttp import web
+from codes.dy_ks_request import Down
+from codes.douyin_downloader import DouyinDownloader
+from utils.links import normalize_url
+from utils.metrics import metrics
+from utils.shard import use_uvloop
+
+KINDS = ("media", "douyin")
+
+
+class Daemon:
+    def __init__(self):
+        self.down = Down()
+        self.douyin = DouyinDownloader()
+        # 两种任务请求的是同一个解析接口，共用一个 Resolver：限速和并发窗口只有一份，解析缓存也只有一个连接
+        self.douyin.resolver.cache.close()
+        self.douyin.resolver = self.down.resolver
+        self.config = self.down.config
+        self.host = self.config.get("daemon", "host", fallback="127.0.0.1")
+        self.port = self.config.getint("daemon", "port", fallback=8686)
+        self.workers = self.config.getint("daemon", "workers", fallback=8)
+        # 内存中最多保留的任务数，超出后丢弃最早完成的任务（任务清单里仍有记录）；也是排队任务数的上限
+        self.max_jobs = self.config.getint("daemon", "max_jobs", fallback=10000)
+        self.ids = itertools.count(1)
+        self.jobs = collections.OrderedDict()
+        self.queue = None
+        # 已登记但还没进入处理队列的任务，提交接口只往这里追加，立即返回
+        self.backlog = collections.deque()
+        self.backlog_ready = None
+        self.subscribers = set()
+        self.sessions = None
+        self.media_sem = None
+        self.douyin_download = None
+        self.douyin_transcode = None
+
+    def new_job(self, kind, url, priority=0):
+        job = {"id": str(next(self.ids)), "kind": kind, "url": url, "priority": priority, "state": "queued",
+               "files": [], "errors": [], "submitted": time.time(), "finished": None}
+        self.jobs[job["id"]] = job
+        while len(self.jobs) > self.max_jobs:
+            oldest = next(iter(self.jobs.values()))
+            if oldest["finished"] is None:
+                break
+            self.jobs.popitem(last=False)
+        return job
+
+    async def run_job(self, job):
+        job["state"] = "running"
+        if job["kind"] == "douyin":
+            info, done = await self.douyin.resolve_job(self.sessions, job["url"])
+            if done:
+                job["files"].append(done)
+            elif info is None:
+                job["errors"].append("解析失败")
+            else:
+                download_time = 0.0
+                sem = self.douyin_transcode if info.get("is_video") else self.douyin_download
+                if self.douyin.needs_spool(info):
+                    # 视频先占用下载并发下载到本地，再占用转码并发
+                    result = await self.douyin.spool_job(self.douyin_download, self.sessions.media, job["url"], info,
+                                                         priority=job["priority"])
+                    download_time = result.download_time
+                if not self.douyin.needs_spool(info) or result.ok:
+                    result = await self.douyin.download_job(sem, self.sessions.media, job["url"], info,
+                                                            priority=job["priority"], download_time=download_time)
+                (job["files"] if result.ok else job["errors"]).append(result.path if result.ok else result.message)
+        else:
+            ret = await self.down.link_flight.do(job["url"], self.down.process_link, self.media_sem, self.sessions,
+                                                 job["url"], job["priority"])
+            job["files"].extend(ret["files"])
+            job["errors"].extend(ret["errors"])
+        job["state"] = "failed" if job["errors"] else "done"
+
+    async def feeder(self):
+        """
+        把提交的任务按顺序送进有界的处理队列，队列满时在这里等待，不阻塞提交接口
+        """
+        while True:
+            while not self.backlog:
+                self.backlog_ready.clear()
+                await self.backlog_ready.wait()
+            await self.queue.put(self.backlog.popleft())
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run_job(job)
+            except Exception as e:
+                job["state"] = "failed"
+                job["errors"].append("任务异常: {}".format(e))
+            finally:
+                job["finished"] = time.time()
+                self.queue.task_done()
+                self.publish(job)
+
+    def publish(self, job):
+        line = (json.dumps(job, ensure_ascii=False) + "\n").encode("utf-8")
+        for inbox in self.subscribers:
+            if inbox.full():
+                # 订阅方读得太慢时丢掉最旧的事件，不阻塞下载
+                inbox.get_nowait()
+            inbox.put_nowait(line)
+
+    # ---------------------------------------------------------------- HTTP 接口
+
+    async def submit(self, request):
+        kind = request.query.get("kind", "media")
+        priority = request.query.get("priority", 0)
+        if request.content_type == "application/json":
+            try:
+                body = await request.json()
+            except ValueError:
+                raise web.HTTPBadRequest(text="json 格式有误")
+            if not isinstance(body, dict):
+                raise web.HTTPBadRequest(text="json 必须是对象")
+            kind = body.get("kind", kind)
+            priority = body.get("priority", priority)
+            urls = body.get("urls") or ([body["url"]] if body.get("url") else [])
+            if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+                raise web.HTTPBadRequest(text="url 必须是字符串，urls 必须是字符串列表")
+        else:
+            urls = (await request.text()).splitlines()
+        if kind not in KINDS:
+            raise web.HTTPBadRequest(text="kind 只能是 {}".format("/".join(KINDS)))
+        try:
+            priority = int(priority)
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text="priority 必须是整数")
+
+        urls = [url for url in map(normalize_url, urls) if url]
+        if not urls:
+            raise web.HTTPBadRequest(text="没有找到有效的链接")
+        if len(self.backlog) + len(urls) > self.max_jobs:
+            # 积压太多时拒绝，避免无限占用内存
+            raise web.HTTPServiceUnavailable(text="排队的任务过多，请稍后再提交", headers={"Retry-After": "30"})
+
+        jobs = []
+        for url in urls:
+            job = self.new_job(kind, url, priority)
+            (self.douyin if kind == "douyin" else self.down).manifest.add(url)
+            self.backlog.append(job)
+            jobs.append({"id": job["id"], "url": url})
+        self.backlog_ready.set()
+        return web.json_response({"jobs": jobs}, status=202)
+
+    async def list_jobs(self, request):
+        state = request.query.get("state")
+        try:
+            limit = int(request.query.get("limit", 100))
+        except ValueError:
+            raise web.HTTPBadRequest(text="limit 必须是整数")
+        jobs = [job for job in reversed(self.jobs.values()) if state is None or job["state"] == state]
+        return web.json_response({"queued": self.queue.qsize() + len(self.backlog), "jobs": jobs[:limit]})
+
+    async def get_job(self, request):
+        job = self.jobs.get(request.match_info["id"])
+        if job is None:
+            raise web.HTTPNotFound(text="任务不存在")
+        return web.json_response(job)
+
+    async def events(self, request):
+        resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await resp.prepare(request)
+        inbox = asyncio.Queue(maxsize=1000)
+        self.subscribers.add(inbox)
+        try:
+            while True:
+                line = await inbox.get()
+                if line is None:
+                    break
+                await resp.write(line)
+        except ConnectionResetError:
+            pass
+        finally:
+            self.subscribers.discard(inbox)
+        return resp
+
+    async def close_events(self, app):
+        """
+        服务停止时结束所有 /events 订阅，否则 aiohttp 会等这些长连接超时才退出
+        """
+        for inbox in self.subscribers:
+            if inbox.full():
+                inbox.get_nowait()
+            inbox.put_nowait(None)
+
+    async def lifetime(self, app):
+        """
+        服务运行期间一直保持的状态：会话、指标和处理任务的协程
+        """
+        self.queue = asyncio.Queue(maxsize=self.config.getint("pipeline", "queue_size", fallback=100))
+        self.backlog_ready = asyncio.Event()
+        self.media_sem = asyncio.Semaphore(10)
+        self.douyin_download = asyncio.Semaphore(self.douyin.download_workers)
+        self.douyin_transcode = asyncio.Semaphore(self.douyin.transcode_workers)
+        async with metrics.run(), self.down.session_factory.open() as sessions:
+            self.sessions = sessions
+            tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+            tasks.append(asyncio.create_task(self.feeder()))
+            print("[*] 服务已启动: http://{}:{}".format(self.host, self.port))
+            yield
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/jobs", self.submit)
+        app.router.add_get("/jobs", self.list_jobs)
+        app.router.add_get("/jobs/{id}", self.get_job)
+        app.router.add_get("/events", self.events)
+        app.on_shutdown.append(self.close_events)
+        app.cleanup_ctx.append(self.lifetime)
+        return app
+
+    def main(self, argv=None):
+        parser = argparse.ArgumentParser(description="抖音、快手下载常驻服务")
+        parser.add_argument("--host", default=self.host)
+        parser.add_argument("--port", type=int, default=self.port)
+        args = parser.parse_args(argv)
+        self.host, self.port = args.host, args.port
+        use_uvloop()
+        web.run_app(self.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    Daemon().main()
@@ -9,15 +9,29 @@ parent_dir = os.path.dirname(current_dir)
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
-import subprocess
+import argparse
 import asyncio
-import aiohttp
+import contextlib
 import json
-import aiofiles
-from yarl import URL
-from aiohttp import ClientError, ConnectionTimeoutError, ClientConnectorError
+import re
+from urllib.parse import urlsplit
 from asyncio.exceptions import TimeoutError
 from utils.utils import Utils
+from utils.resolver import Resolver
+from utils.retry import RetryPolicy, RetryableError
+from utils.session import SessionFactory
+from utils.metrics import metrics
+from utils.bandwidth import bandwidth
+from utils.sink import SinkOptions
+from utils.transcode import TranscodePool
+from utils.manifest import JobManifest, RESOLVED, DOWNLOADED, TRANSCODED, DONE, FAILED
+from utils.links import normalize_url
+from utils.singleflight import SingleFlight
+from utils.result import Result, iter_results, SKIPPED, RESOLVE
+from utils.shard import run_sharded, use_uvloop
+
+_STOP = object()  # 流水线结束标记
+
 
 class DouyinDownloader(Utils):
     def __init__(self):
@@ -25,197 +39,609 @@ class DouyinDownloader(Utils):
         self.config = self.read_config(filepath=("config",), filename="config.ini")
         self.timeout = 60  # 增加超时时间到60秒
         self.rep_count = self.config.getint("options", "rep_count")
+        self.segments = self.config.getint("options", "segments", fallback=4)
+        self.min_segment_size = self.config.getint("options", "min_segment_size", fallback=8 * 1024 * 1024)
+        self.sink_options = SinkOptions.from_config(self.config)
         self.download_dir = self.config.get("download_info", "filepath")
+        # 音频来源选择：探测所有候选链接，选不低于目标码率、传输量最小且尽量不用转码的
+        self.probe_sources = self.config.getboolean("audio", "probe", fallback=True)
+        self.probe_timeout = self.config.getint("audio", "probe_timeout", fallback=10)
+        self.target_bitrate = self.config.getint("audio", "target_bitrate", fallback=32)
+        self.retry_policy = RetryPolicy.from_config(self.config)
+        self.resolver = Resolver.from_config(self.config, self.retry_policy)
+        self.session_factory = SessionFactory.from_config(self.config)
+        metrics.configure(self.config)
+        bandwidth.configure(self.config)
+        # 流水线各阶段的并发数与队列长度
+        self.resolve_workers = self.config.getint("pipeline", "resolve_workers", fallback=8)
+        self.download_workers = self.config.getint("pipeline", "download_workers", fallback=4)
+        # 转码池的并发数与网络并发无关，默认等于 CPU 核数
+        self.transcode_pool = TranscodePool.from_config(self.config)
+        self.transcode_workers = self.transcode_pool.workers
+        self.queue_size = self.config.getint("pipeline", "queue_size", fallback=100)
+        self.processes = self.config.getint("pipeline", "processes", fallback=1)
+        # 任务清单，中断后重新运行时跳过已完成的链接
+        self.manifest = JobManifest.from_config(self.config, "douyin")
+        # 同一个链接同时只下载一次，重复的链接共享结果
+        self.flight = SingleFlight("download")
+        # 本次运行中已分配的保存路径 -> 链接，标题相同的不同链接各自分配文件名
+        self.paths = {}
 
-    @staticmethod
-    async def get_audio_info(session, text):
-        url = "https://su.tuanyougou.com/query"
-        params = {
-            "url": text,
-            "token": "",
-            "id": "",
-            "user_id": "1"
-        }
-        async with session.request(method="GET", url=URL(url, encoded=True), params=params) as resp:
-            if resp.status != 200:
-                return None
-            return json.loads(await resp.text())
+    async def get_audio_info(self, session, text, refresh=False):
+        return await self.resolver.query(session, text, refresh)
 
-    def data_parse(self, data):
+    def data_parse(self, data, link=None, known=None):
+        """
+        :param link: 输入的链接，用于给标题相同的不同链接分配不同的文件名
+        :param known: 上次的解析结果，沿用上次分配的文件名
+        """
         if not data or "data" not in data:
             return None
 
         title = self.teshu(data["data"]["title"])
-        # 优先选取最小码率音频
+        # 候选来源，默认优先选取最小码率音频，最后是视频链接；能探测时由 select_source 重新选择
         audio_keys = [
             "audio_32k_url", "audio_64k_url", "audio_128k_url",
-            "mp3play_url", "m4a_url", "audio_url", "music", "music_url"
+            "mp3play_url", "m4a_url", "audio_url", "music", "music_url", "downurl"
         ]
-        downurl = None
+        candidates = []
         for key in audio_keys:
-            if key in data["data"] and data["data"][key]:
-                downurl = data["data"][key]
-                break
-        # 如果都没有，使用视频链接
-        if not downurl and "downurl" in data["data"]:
-            downurl = data["data"]["downurl"]
-
-        if not downurl:
+            url = data["data"].get(key)
+            if url and isinstance(url, str) and url not in (c[1] for c in candidates):
+                candidates.append((key, url))
+
+        if not candidates:
             print("未找到下载链接")
             return None
+        downurl = candidates[0][1]
 
         self.folders_create(filepath=(self.download_dir,))
-        filename = f"{title}.mp3"
-        file = self.get_current_path(filepath=(self.download_dir,), filename=filename)
+        if known and self.reserve_path(known["filepath"], link):
+            filename, file = known["title"], known["filepath"]
+        else:
+            filename, file = self.allocate_path(title, link)
 
         return {
             "title": filename,
             "truncate_name": self.truncate_string(filename, 30),
             "filepath": file,
             "url": downurl,
-            "is_video": not any(downurl.endswith(ext) for ext in [".mp3", ".m4a"])
+            "is_video": self.needs_transcode(downurl),
+            "candidates": candidates
         }
 
-    async def download_with_ffmpeg(self, session, url, filepath, truncate_name):
-        """使用ffmpeg下载并转码视频"""
+    def allocate_path(self, title, url):
+        """
+        title.mp3 已被其它链接占用时依次改用 title_2.mp3、title_3.mp3 ...
+        本次运行中已分配给其它链接、任务清单里其它未完成的任务已经分配，或磁盘上已有该文件
+        （包括下载中的 .part 和待转码的 .src）都算占用
+        :return: (文件名, 完整路径)
+        """
+        held = self.manifest.held_paths()
+        filename = f"{title}.mp3"
+        num = 1
+        while True:
+            file = self.get_current_path(filepath=(self.download_dir,), filename=filename)
+            if url is None:
+                return filename, file
+            owner = self.paths.get(file)
+            if owner == url or (owner is None and file not in held and not self.file_no_index.on_disk(file) and
+                                self.reserve_path(file, url)):
+                return filename, file
+            num += 1
+            filename = f"{title}_{num}.mp3"
+
+    def reserve_path(self, file, url):
+        """
+        把保存路径登记为 url 占用：本次运行中已分配给其它链接，或磁盘上还没有该文件时抢不到占位
+        （多进程时另一个进程已经创建了 .part），返回 False；磁盘上已有的文件视为 url 上次留下的
+        """
+        owner = self.paths.get(file)
+        if owner is not None:
+            return owner == url
+        if not self.file_no_index.on_disk(file) and not self.file_no_index.claim_path(file):
+            return False
+        self.paths[file] = url
+        return True
+
+    @staticmethod
+    def needs_transcode(url, content_type=None):
+        """
+        音频直接保存，其它（视频）需要 ffmpeg 转码；响应没有给出明确类型时按扩展名判断
+        """
+        if content_type and content_type.startswith("audio/"):
+            return False
+        if content_type and content_type.startswith("video/"):
+            return True
+        return not urlsplit(url).path.lower().endswith((".mp3", ".m4a"))
+
+    @staticmethod
+    def key_bitrate(key):
+        """
+        audio_64k_url -> 64，无法从字段名得知码率时返回 None
+        """
+        m = re.match(r"audio_(\d+)k_url$", key)
+        return int(m.group(1)) if m else None
+
+    async def select_source(self, session, info):
+        """
+        并发探测所有候选链接的实际大小和类型，按以下顺序选择：
+        码率不低于目标码率 > 不需要转码 > Content-Length 最小 > 原有优先级
+        全部探测失败时保留 data_parse 的默认选择；选择结果随解析结果一起记录在任务清单里
+        """
+        candidates = info.pop("candidates", None) or []
+        if len(candidates) < 2 or not self.probe_sources:
+            return info
+        from utils.transfer import probe_media
+
+        with metrics.timer("stage_seconds", stage="probe"):
+            probes = await asyncio.gather(*(probe_media(session, url, self.probe_timeout) for _, url in candidates),
+                                          return_exceptions=True)
+        ranked = []
+        for order, ((key, url), probe) in enumerate(zip(candidates, probes)):
+            if isinstance(probe, Exception):
+                continue
+            length, content_type = probe
+            bitrate = self.key_bitrate(key)
+            below = bitrate is not None and bitrate < self.target_bitrate
+            transcode = self.needs_transcode(url, content_type)
+            ranked.append((below, transcode, length if length is not None else float("inf"), order, key, url))
+        if not ranked:
+            return info
+
+        _, transcode, _, _, key, url = min(ranked)
+        metrics.inc("source_total", key=key)
+        info["url"] = url
+        info["is_video"] = transcode
+        return info
+
+    async def iter_media(self, session, url, flow=None):
+        """通过共享的 aiohttp 会话按块读取远端文件，供 ffmpeg 从标准输入读取"""
+        from yarl import URL
+        from utils.transfer import make_timeout
+
+        async with session.request(method="GET", url=URL(url, encoded=True),
+                                   timeout=make_timeout(self.timeout)) as resp:
+            resp.raise_for_status()
+            if flow is not None:
+                flow.sized(resp.content_length)
+            async for b in resp.content.iter_chunked(self.sink_options.chunk_size):
+                if b:
+                    if flow is not None:
+                        await flow.consume(len(b))
+                    metrics.inc("bytes_total", len(b), stage="transcode")
+                    yield b
+
+    async def download_with_ffmpeg(self, session, url, filepath, truncate_name, flow=None):
+        """
+        使用ffmpeg转码视频，交给转码池调度，先输出到 .part 文件，成功后再改名
+        输入方式由 [transcode] input 决定：
+        url   直接把链接交给 ffmpeg 拉取
+        pipe  用 aiohttp 下载，边下边写入 ffmpeg 的标准输入
+        spool 先用 aiohttp 断点续传下载到本地 .src 文件（容器需要 seek 时使用），转码失败重试时不用重新下载
+        """
+        from aiohttp import ClientError
+        from utils.transfer import fetch_segmented
+
+        part = filepath + ".part"
+        source = filepath + ".src"
+        mode = self.transcode_pool.input_mode
+        stdin = None
+        if mode == "pipe":
+            src, stdin = "pipe:0", self.iter_media(session, url, flow)
+        elif mode == "spool":
+            if not os.path.isfile(source):
+                await fetch_segmented(session, url, source, self.timeout, self.segments, self.min_segment_size,
+                                      options=self.sink_options, flow=flow)
+            src = source
+        else:
+            src = url
+
         ffmpeg_cmd = [
             "ffmpeg", "-y",
-            "-i", url,  # 直接使用URL作为输入
+            "-i", src,
             "-vn",  # 不处理视频
             "-acodec", "libmp3lame",  # 使用mp3编码器
             "-ar", "44100",  # 采样率
             "-ab", "32k",  # 比特率
             "-f", "mp3",  # 输出格式
-            filepath
+            part
         ]
         
         try:
-            process = await asyncio.create_subprocess_exec(
-                *ffmpeg_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode == 0 and os.path.isfile(filepath) and os.path.getsize(filepath) > 0:
+            with metrics.timer("stage_seconds", stage="transcode"):
+                returncode, tail = await self.transcode_pool.run(ffmpeg_cmd, stdin=stdin)
+            if returncode == 0 and os.path.isfile(part) and os.path.getsize(part) > 0:
+                os.replace(part, filepath)
+                if os.path.isfile(source):
+                    os.remove(source)
                 return filepath
             else:
-                print(f"[{truncate_name}] ffmpeg错误: {stderr.decode()}")
+                print(f"[{truncate_name}] ffmpeg错误: " + "\n".join(tail))
                 return None
+        except (ClientError, TimeoutError):
+            # 网络错误交给重试策略处理
+            raise
         except Exception as e:
             print(f"[{truncate_name}] ffmpeg执行错误: {e}")
             return None
 
     async def download(self, semaphore, session, **info):
+        """
+        :return: 成功时返回文件路径，失败时返回错误信息
+        """
+        result = await self.download_item(semaphore, session, info)
+        return result.path if result.ok else result.message
+
+    def needs_spool(self, info):
+        """
+        spool 模式下视频先在下载阶段下载到本地，转码阶段只运行 ffmpeg
+        """
+        return bool(info.get("is_video")) and self.transcode_pool.input_mode == "spool"
+
+    async def download_item(self, semaphore, session, info, url=None, resolve_time=0.0, priority=0, spool=False,
+                            download_time=0.0):
+        """
+        下载 / 转码一个已解析的链接，同一个链接同时只处理一次
+        :param url: 输入的链接，记录在结果里，默认为媒体地址
+        :param resolve_time: 解析该链接的耗时，记录在结果里
+        :param priority: 带宽调度的优先级，见 BandwidthScheduler.flow
+        :param spool: 只把视频下载到本地 .src 文件（结果的 path 为 .src 文件），不转码
+        :param download_time: 之前下载 .src 的耗时，记录在结果里
+        :return: Result
+        """
+        url = url or info["url"]
+        return await self.flight.do(("spool" if spool else "item", url), self.download_file, semaphore, session,
+                                    info, url, resolve_time, priority, spool, download_time)
+
+    async def download_file(self, semaphore, session, info, url, resolve_time, priority, spool, download_time):
+        # aiohttp 导入较慢，真正下载时才导入，只查询任务状态时不用等
+        from aiohttp import ClientError, ClientResponseError
+        from utils.transfer import fetch_segmented
+
         await asyncio.sleep(0.2)
         async with self.lock:
             print("正在下载:", info["truncate_name"])
+        flow = bandwidth.flow(info["url"], priority)
+
+        async def attempt():
+            if spool:
+                # 下载完整后才会出现 .src 文件，已存在说明上次已经下载过
+                source = info["filepath"] + ".src"
+                if not os.path.isfile(source):
+                    with metrics.timer("stage_seconds", stage="download"):
+                        await fetch_segmented(session, info["url"], source, self.timeout, self.segments,
+                                              self.min_segment_size, options=self.sink_options, flow=flow)
+                return source
+            if not info.get("is_video"):
+                # 直接下载音频
+                with metrics.timer("stage_seconds", stage="download"):
+                    await fetch_segmented(session, info["url"], info["filepath"], self.timeout,
+                                          self.segments, self.min_segment_size, options=self.sink_options,
+                                          flow=flow)
+                return info["filepath"]
+            # 使用ffmpeg转码
+            print(f"[{info['truncate_name']}] 使用ffmpeg转码为32k mp3")
+            result = await self.download_with_ffmpeg(session, info["url"], info["filepath"], info["truncate_name"],
+                                                     flow)
+            if not result:
+                raise RetryableError("ffmpeg转码失败")
+            return result
+
+        stage = "transcode" if info.get("is_video") and not spool else "download"
+
+        def timings():
+            ret = {"resolve_time": resolve_time, "download_time": download_time}
+            ret[stage + "_time"] = time.perf_counter() - start
+            return ret
 
         async with semaphore:
-            for rep in range(1, self.rep_count + 1):
-                try:
-                    url = info["url"]
-                    if not info.get("is_video"):
-                        # 直接下载音频
-                        async with session.request(method="GET", url=URL(url, encoded=True), timeout=self.timeout) as resp:
-                            if resp.status == 200:
-                                async with aiofiles.open(info["filepath"], mode="wb") as f:
-                                    async for b in resp.content.iter_chunked(1024 * 1024):
-                                        if b:
-                                            await f.write(b)
-                                if os.path.isfile(info["filepath"]) and os.path.getsize(info["filepath"]) > 0:
-                                    return info["filepath"]
-                                else:
-                                    return f"[{info['truncate_name']}] 下载失败~"
-                            else:
-                                print(f"[{info['truncate_name']}] 请求失败: {resp.status}")
-                                print(f"重试中...{rep}/{self.rep_count}")
-                    else:
-                        # 使用ffmpeg直接下载并转码
-                        print(f"[{info['truncate_name']}] 使用ffmpeg下载并转码为32k mp3")
-                        result = await self.download_with_ffmpeg(
-                            session, url, info["filepath"], info["truncate_name"]
-                        )
-                        if result:
-                            return result
-                        print(f"重试中...{rep}/{self.rep_count}")
-                        
-                except (ClientError, ConnectionTimeoutError, ClientConnectorError) as e:
-                    print(f"[{info['truncate_name']}] 下载文件时出错: {e}")
-                    print(f"等待 2 秒后重试...{rep}/{self.rep_count}")
-                    await asyncio.sleep(2)
-                except TimeoutError as e:
-                    print(f"[{info['truncate_name']}] 下载文件时超时: {repr(e)}")
-                    print(f"等待 2 秒后重试...{rep}/{self.rep_count}")
-                    await asyncio.sleep(2)
-                except Exception as e:
-                    print(f"[{info['truncate_name']}] 其它异常: {e}")
-                    return f"[{info['truncate_name']}] 下载异常~"
-            return f"[{info['truncate_name']}] 下载失败~"
+            start = time.perf_counter()
+            try:
+                with metrics.timer("stage_seconds", stage=stage + "_total"):
+                    ret = await self.retry_policy.run(attempt, info["truncate_name"])
+                metrics.inc("items_total", stage=stage, result="ok")
+                return Result(url, ret, **timings())
+            except ClientResponseError as e:
+                print(f"[{info['truncate_name']}] 请求失败: {e.status}")
+                error = e
+            except (ClientError, TimeoutError, RetryableError) as e:
+                print(f"[{info['truncate_name']}] 下载文件时出错: {e!r}")
+                error = e
+            except Exception as e:
+                metrics.inc("items_total", stage=stage, result="error")
+                print(f"[{info['truncate_name']}] 其它异常: {e}")
+                return Result.failed(url, e, message=f"[{info['truncate_name']}] 下载异常~", **timings())
+            metrics.inc("items_total", stage=stage, result="failed")
+            return Result.failed(url, error, message=f"[{info['truncate_name']}] 下载失败~", **timings())
 
-    async def process_url(self, session, url):
-        response = await self.get_audio_info(session, url)
+    async def process_url(self, session, url, media_session=None, known=None):
+        """
+        :param media_session: 探测媒体链接用的会话，为 None 时使用 session
+        :param known: 上次的解析结果，传入时不读解析缓存重新解析，并沿用上次的文件名
+        """
+        response = await self.get_audio_info(session, url, refresh=known is not None)
         if not response:
             print(f"无法获取链接信息: {url}")
             return None
             
-        data = self.data_parse(response)
+        data = self.data_parse(response, url, known)
         if not data:
             print(f"解析数据失败: {url}")
             return None
             
-        return data
+        return await self.select_source(media_session or session, data)
 
-    async def client(self, urls):
-        semaphore = asyncio.Semaphore(1)  # 限制并发数为1
-        async with aiohttp.ClientSession() as session:
-            tasks = []
+    async def resolve_job(self, sessions, url):
+        """
+        解析一个链接并记录到任务清单，上次已解析过的直接复用解析结果，上次失败的重新解析（沿用文件名）
+        :return: (info, done)：info 为下载信息，解析失败时为 None；上次已完成时 done 为已有文件路径
+        """
+        job = self.manifest.get(url)
+        if self.manifest.is_done(job):
+            return None, job["path"]
+        known = job["meta"] if job else None
+        if known and not self.reserve_path(known["filepath"], url):
+            # 上次分配的文件名本次已经分配给了其它链接，重新解析并分配新的文件名
+            known = None
+        if known and job["state"] != FAILED:
+            # 沿用上次分配的文件名，本次运行中不再分配给其它链接
+            return known, None
+        try:
+            # 失败的任务重新解析且不读缓存，上次的媒体链接可能已经过期
+            result = await self.process_url(sessions.resolver, url, sessions.media, known)
+        except Exception as e:
+            print(f"无法获取链接信息: {url} {e}")
+            result = None
+        if result is None and known:
+            # 重新解析失败时退回上次的解析结果
+            return known, None
+        if result is None:
+            self.manifest.mark(url, FAILED, error="解析失败")
+            return None, None
+        self.manifest.mark(url, RESOLVED, meta=result)
+        return result, None
+
+    async def spool_job(self, semaphore, session, url, info, resolve_time=0.0, priority=0):
+        """
+        在下载阶段把视频下载到本地 .src 文件，失败时记录到任务清单
+        :return: Result，成功时 path 为 .src 文件，之后交给 download_job 转码
+        """
+        result = await self.download_item(semaphore, session, info, url, resolve_time, priority, spool=True)
+        if not result.ok:
+            self.manifest.mark(url, FAILED, error=result.message)
+        return result
+
+    async def download_job(self, semaphore, session, url, info, resolve_time=0.0, priority=0, download_time=0.0):
+        """
+        下载 / 转码一个已解析的链接并记录结果
+        :return: Result
+        """
+        result = await self.download_item(semaphore, session, info, url, resolve_time, priority,
+                                          download_time=download_time)
+        if result.ok:
+            self.manifest.mark(url, TRANSCODED if info.get("is_video") else DOWNLOADED)
+            self.manifest.mark(url, DONE, path=result.path)
+            # 文件已经落盘，之后靠磁盘上的文件避免重名
+            if self.paths.get(info["filepath"]) == url:
+                del self.paths[info["filepath"]]
+        else:
+            self.manifest.mark(url, FAILED, error=result.message)
+        return result
+
+    @staticmethod
+    async def _stage(name, inbox, workers, handler):
+        """
+        启动一个流水线阶段：workers 个协程从 inbox 取任务交给 handler 处理，收到 _STOP 后退出
+        """
+        async def worker():
+            while True:
+                item = await inbox.get()
+                metrics.gauge("queue_depth", inbox.qsize(), queue=name)
+                try:
+                    if item is _STOP:
+                        return
+                    await handler(item)
+                except Exception as e:
+                    print(f"流水线任务异常: {e}")
+                finally:
+                    inbox.task_done()
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+    async def pipeline(self, sessions, urls, emit, priority=0):
+        """
+        分阶段流水线：读取链接 -> 解析 -> 下载 -> 转码（spool 模式下视频先在下载阶段下载到本地）
+        每个阶段有独立的并发数和有界队列，解析与下载同时进行，内存占用与输入文件大小无关
+        每个链接处理完时以 Result 调用 emit（协程函数）
+        :param urls: 链接的可迭代对象（可以是惰性读取文件的生成器）
+        :param priority: 带宽调度的优先级
+        """
+        resolve_q = asyncio.Queue(maxsize=self.queue_size)
+        download_q = asyncio.Queue(maxsize=self.queue_size)
+        transcode_q = asyncio.Queue(maxsize=self.queue_size)
+        download_sem = asyncio.Semaphore(self.download_workers)
+        transcode_sem = asyncio.Semaphore(self.transcode_workers)
+
+        async def on_resolve(url):
+            start = time.perf_counter()
+            info, done = await self.resolve_job(sessions, url)
+            resolve_time = time.perf_counter() - start
+            if done:
+                await emit(Result(url, done, status=SKIPPED))
+            elif info is None:
+                await emit(Result.failed(url, error=RESOLVE, message=f"[{url}] 解析失败~", resolve_time=resolve_time))
+            elif info.get("is_video") and not self.needs_spool(info):
+                # url / pipe 模式由 ffmpeg 边下载边转码，只能放在转码阶段
+                await transcode_q.put((url, info, resolve_time, 0.0))
+            else:
+                await download_q.put((url, info, resolve_time))
+
+        async def on_download(item):
+            url, info, resolve_time = item
+            if not self.needs_spool(info):
+                await emit(await self.download_job(download_sem, sessions.media, url, info, resolve_time, priority))
+                return
+            # 网络下载占用下载阶段的并发，下载完成后把本地文件交给转码阶段
+            spooled = await self.spool_job(download_sem, sessions.media, url, info, resolve_time, priority)
+            if spooled.ok:
+                await transcode_q.put((url, info, resolve_time, spooled.download_time))
+            else:
+                await emit(spooled)
+
+        async def on_transcode(item):
+            url, info, resolve_time, download_time = item
+            await emit(await self.download_job(transcode_sem, sessions.media, url, info, resolve_time, priority,
+                                               download_time))
+
+        resolvers = asyncio.create_task(self._stage("resolve", resolve_q, self.resolve_workers, on_resolve))
+        downloaders = asyncio.create_task(self._stage("download", download_q, self.download_workers, on_download))
+        transcoders = asyncio.create_task(self._stage("transcode", transcode_q, self.transcode_workers, on_transcode))
+        stages = (resolvers, downloaders, transcoders)
+        try:
+            # 逐行投递，队列满时在这里等待，实现背压
             for url in urls:
-                url = url.strip()
+                # 分享文本中取出作品链接，同一作品的不同写法归为同一个任务
+                url = normalize_url(url)
                 if url:
-                    task = asyncio.create_task(self.process_url(session, url))
-                    tasks.append(task)
-            
-            results = await asyncio.gather(*tasks)
-            download_tasks = []
-            
-            for result in results:
-                if result:
-                    download_tasks.append(asyncio.create_task(self.download(semaphore, session, **result)))
-            
-            totals = len(download_tasks)
-            suc_num = 1
-            print(f"[*] 待下载任务:[{totals}]")
+                    self.manifest.add(url)
+                    await resolve_q.put(url)
+            for _ in range(self.resolve_workers):
+                await resolve_q.put(_STOP)
+            await resolvers
+
+            # 下载阶段还会往转码队列投递，等它结束后再结束转码阶段
+            for _ in range(self.download_workers):
+                await download_q.put(_STOP)
+            await downloaders
+            for _ in range(self.transcode_workers):
+                await transcode_q.put(_STOP)
+            await transcoders
+        finally:
+            for task in stages:
+                task.cancel()
+            # 等各阶段真正退出后再返回，否则调用方接着关闭会话时还有协程在用
+            await asyncio.gather(*stages, return_exceptions=True)
+
+    async def stream(self, urls, priority=0):
+        """
+        按完成顺序逐个产出 Result，每个链接一个（上次已完成的链接 status 为 skipped）
+            async for result in DouyinDownloader().stream(urls):
+                ...
+        结果队列长度为 [pipeline] queue_size，调用方处理得慢时整条流水线随之暂停
+        :param priority: 带宽调度的优先级
+        """
+        out = asyncio.Queue(maxsize=self.queue_size)
+        # 显式关闭内层生成器，提前退出时先停下流水线再关闭会话
+        async with self.session_factory.open() as sessions, \
+                contextlib.aclosing(iter_results(self.pipeline(sessions, urls, out.put, priority), out)) as results:
+            async for result in results:
+                yield result
+
+    @staticmethod
+    def new_summary():
+        return {"links": 0, "succeeded": 0, "failed": 0, "skipped": 0, "failures": []}
 
-            for task in download_tasks:
-                ret = await task
-                print(f"[*] 已完成: [{suc_num}/{totals}] 下载路径:{ret}")
-                suc_num += 1
+    async def client(self, urls, totals=None):
+        """
+        :param urls: 链接的可迭代对象（可以是惰性读取文件的生成器）
+        :param totals: 链接总数，只用于打印进度
+        :return: 汇总信息
+        """
+        summary = self.new_summary()
+        async with metrics.run():
+            if totals is not None:
+                print(f"[*] 待下载任务:[{totals}]")
+            async for result in self.stream(urls):
+                summary["links"] += 1
+                if result.status == SKIPPED:
+                    summary["skipped"] += 1
+                    ret = f"{result.path} (已完成，跳过)"
+                else:
+                    ret = result.path if result.ok else result.message
+                if result.ok:
+                    summary["succeeded"] += 1
+                else:
+                    summary["failed"] += 1
+                    summary["failures"].append({"url": result.url, "error": result.message})
+                print(f"[*] 已完成: [{summary['links']}/{totals or '?'}] 下载路径:{ret}")
+        return summary
+
+    def iter_urls_from_file(self, file_path):
+        """
+        按行惰性读取链接，不会一次性把整个文件读进内存
+        """
+        return self.iter_urls([file_path])
 
     def read_urls_from_file(self, file_path):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return [line.strip() for line in f if line.strip()]
-        except Exception as e:
-            print(f"读取文件失败: {e}")
-            return []
+        return list(self.iter_urls_from_file(file_path))
+
+    def run(self, urls, totals=None, processes=1):
+        """
+        :param processes: 大于 1 时按链接分片到多个进程并行下载，各进程的汇总合并后返回
+        :return: 汇总信息
+        """
+        if processes > 1:
+            return run_sharded(shard_worker, urls, processes, self.new_summary())
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(self.client(urls, totals=totals))
+
+    def main(self, argv=None):
+        """
+        不带参数时交互式输入文件路径；也可以直接传入文件路径，或者：
+            --status        查看任务清单中各状态的数量和最近的失败
+            --retry-failed  重新处理清单中所有未完成（失败或中断）的链接
+            -p N            按链接分片到 N 个进程并行下载
+        """
+        parser = argparse.ArgumentParser(description="抖音音频批量下载")
+        parser.add_argument("file", nargs="?", help="包含抖音链接的txt文件路径")
+        parser.add_argument("--status", action="store_true", help="查看任务清单的状态")
+        parser.add_argument("--retry-failed", action="store_true", help="重新处理失败或未完成的链接")
+        parser.add_argument("-p", "--processes", type=int, default=self.processes,
+                            help="进程数，大于 1 时按链接分片到多个进程并行下载")
+        args = parser.parse_args(argv)
+
+        if args.status:
+            print(json.dumps(self.manifest.status(), ensure_ascii=False, indent=2))
+            return
+        if args.retry_failed:
+            self.report(self.run(self.manifest.iter_unfinished(), processes=args.processes))
+            return
 
-    def main(self):
-        file_path = input("请输入包含抖音链接的txt文件路径: ")
+        file_path = args.file or input("请输入包含抖音链接的txt文件路径: ")
         if not os.path.exists(file_path):
             print("文件不存在！")
             return
             
-        urls = self.read_urls_from_file(file_path)
-        if not urls:
+        totals = sum(1 for _ in self.iter_urls_from_file(file_path))
+        if not totals:
             print("文件中没有找到有效的链接！")
             return
             
-        print(f"共找到 {len(urls)} 个链接")
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.client(urls))
+        print(f"共找到 {totals} 个链接")
+        self.report(self.run(self.iter_urls_from_file(file_path), totals=totals, processes=args.processes))
+
+    @staticmethod
+    def report(summary):
+        print(f"[*] 链接数:{summary['links']} 成功:{summary['succeeded']} 失败:{summary['failed']} "
+              f"跳过:{summary['skipped']}")
+        for failure in summary["failures"]:
+            print(f"    {failure['url']}: {failure['error']}")
+
+
+def shard_worker(index, path):
+    """
+    多进程分片运行时在子进程中处理一个分片文件，返回该分片的汇总
+    """
+    use_uvloop()
+    # 标题相同的作品可能分在不同进程，分配 title_N.mp3 时用 .part 占位文件在进程间互斥
+    Utils.file_no_index.exclusive = True
+    downloader = DouyinDownloader()
+    metrics.shard(index)
+    return asyncio.run(downloader.client(downloader.iter_urls([path])))
+
 
 if __name__ == '__main__':
     downloader = DouyinDownloader()
-    downloader.main() 
\ No newline at end of file
+    downloader.main()
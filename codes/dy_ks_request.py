@@ -7,6 +7,8 @@
 import time
 import sys
 import os
+import argparse
+import contextlib
 
 # 添加项目根目录到Python路径
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -14,13 +16,21 @@ parent_dir = os.path.dirname(current_dir)
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
-import aiohttp
 import asyncio
 import json
-import aiofiles
 from utils.utils import Utils
-from yarl import URL
-from aiohttp import ClientError, ConnectionTimeoutError, ClientConnectorError
+from utils.resolver import Resolver
+from utils.retry import RetryPolicy
+from utils.session import SessionFactory
+from utils.metrics import metrics
+from utils.bandwidth import bandwidth
+from utils.sink import SinkOptions
+from utils.manifest import JobManifest, RESOLVED, DOWNLOADED, DONE, FAILED
+from utils.result import Result, iter_results, SKIPPED, RESOLVE
+from utils.dedup import DedupStore, new_hasher
+from utils.shard import run_sharded, use_uvloop
+from utils.links import normalize_url
+from utils.singleflight import SingleFlight
 from asyncio.exceptions import TimeoutError
 
 
@@ -30,22 +40,32 @@ class Down(Utils):
         self.config = self.read_config(filepath=("config",), filename="config.ini")
         self.timeout = self.config.getint("options", "timeout")
         self.rep_count = self.config.getint("options", "rep_count")
+        self.segments = self.config.getint("options", "segments", fallback=4)
+        self.min_segment_size = self.config.getint("options", "min_segment_size", fallback=8 * 1024 * 1024)
+        self.sink_options = SinkOptions.from_config(self.config)
+        self.batch_workers = self.config.getint("pipeline", "batch_workers", fallback=4)
+        self.processes = self.config.getint("pipeline", "processes", fallback=1)
+        self.retry_policy = RetryPolicy.from_config(self.config)
+        self.resolver = Resolver.from_config(self.config, self.retry_policy)
+        self.session_factory = SessionFactory.from_config(self.config)
+        metrics.configure(self.config)
+        bandwidth.configure(self.config)
+        # 任务清单，中断后重新运行时跳过已完成的链接，并沿用上次分配的文件名
+        self.manifest = JobManifest.from_config(self.config, "media")
+        # 按内容去重，未开启时为 None
+        self.dedup = DedupStore.from_config(self.config)
+        # 同一个链接、同一个文件同时只处理一次
+        self.link_flight = SingleFlight("link")
+        self.flight = SingleFlight("download")
 
-    @staticmethod
-    async def get_pic_vid(session, text):
-        url = "https://su.tuanyougou.com/query"
-        params = {
-            "url": text,
-            "token": "",
-            "id": "",
-            "user_id": "1"
-        }
-        async with session.request(method="GET", url=URL(url, encoded=True), params=params) as resp:
-            if resp.status != 200:
-                return
-            return json.loads(await resp.text())
-
-    def data_parse(self, data):
+    async def get_pic_vid(self, session, text, refresh=False):
+        return await self.resolver.query(session, text, refresh)
+
+    def data_parse(self, data, known=None, link=None):
+        """
+        :param known: 上次的解析结果，同一目录下沿用上次分配给各作品的文件名
+        :param link: 输入链接，作为文件名的占用者；上次的文件名已被其它链接占用时重新分配
+        """
         title = self.teshu(data["data"]["title"])
         typ = data["data"]["type"]
         downurl = data["data"]["downurl"]
@@ -54,33 +74,34 @@ class Down(Utils):
         all_opus = []  # 所有作品
         date = time.strftime("%Y年%m月")
         down_filepath = self.config.get("download_info", "filepath")
+        # 任务清单里其它未完成任务已经分配的文件名，新分配时跳过
+        held = self.manifest.held_paths()
         if typ == 1:
             filepath = self.get_current_path(filepath=(down_filepath, date, "videos", title))
             self.folders_create(filepath=(filepath,))
 
-            num = 1
-            file_no = self.get_file_no3(filepath=(filepath,), filename=title + "_%05d.mp4" % (num,), fno=num)
-            filename = file_no["file"]
+            filename = self.previous_filename(known, 0, filepath, link) or self.known_filename(filepath, downurl)
+            if filename is None:
+                num = 1
+                file_no = self.get_file_no3(filepath=(filepath,), filename=title + "_%05d.mp4" % (num,), fno=num,
+                                            owner=link, held=held)
+                filename = file_no["file"]
 
             file = self.get_current_path(filepath=(filepath,), filename=filename)
             all_opus.append({"title": filename, "truncate_name": self.truncate_string(filename, 30), "filepath": file,
-                             "url": downurl})
+                             "url": downurl, "segmented": True})
         elif typ == 2:
             filepath = self.get_current_path(filepath=(down_filepath, date, "images", title))
             self.folders_create(filepath=(filepath,))
 
-            filenames = set()
             num = 1
-            for v in pics:
-                while True:
-                    file_no = self.get_file_no3(filepath=(filepath,), filename=title + "_%05d.png" % (num,), fno=num)
+            for i, v in enumerate(pics):
+                filename = self.previous_filename(known, i, filepath, link) or self.known_filename(filepath, v)
+                if filename is None:
+                    file_no = self.get_file_no3(filepath=(filepath,), filename=title + "_%05d.png" % (num,), fno=num,
+                                                owner=link, held=held)
                     filename = file_no["file"]
-                    if filename not in filenames:
-                        filenames.add(filename)
-                        num = file_no["fno"] + 1
-                        break
-                    else:
-                        num += 1
+                    num = file_no["fno"] + 1
                 file = self.get_current_path(filepath=(filepath,), filename=filename)
                 all_opus.append(
                     {"title": filename, "truncate_name": self.truncate_string(filename, 30), "filepath": file,
@@ -90,58 +111,351 @@ class Down(Utils):
             return None
         return all_opus
 
+    def previous_filename(self, known, index, folder, link=None):
+        """
+        上次分配给第 index 个作品的文件名（只在同一目录下沿用），重新登记为 link 占用；
+        本次运行中已被其它链接占用时返回 None，重新分配
+        """
+        if known and index < len(known) and os.path.dirname(known[index]["filepath"]) == folder and \
+                self.file_no_index.reserve_exact(known[index]["filepath"], link):
+            return os.path.basename(known[index]["filepath"])
+        return None
+
+    def reserve_known(self, known, link):
+        """
+        沿用上次的解析结果前重新登记其中的文件名；有文件名已被其它链接占用时返回 False，需要重新解析分配
+        """
+        return all(self.file_no_index.reserve_exact(ts["filepath"], link) for ts in known)
+
+    def known_filename(self, folder, url):
+        """
+        该链接之前已经下载到同一目录时沿用原来的文件名，不再分配新编号
+        """
+        if self.dedup is None:
+            return None
+        known = self.dedup.lookup(url)
+        if known and os.path.dirname(known) == folder:
+            return os.path.basename(known)
+        return None
+
     async def download(self, semaphore, session, **info):
+        """
+        :return: 成功时返回文件路径，失败时返回错误信息
+        """
+        result = await self.download_item(semaphore, session, info)
+        return result.path if result.ok else result.message
+
+    async def download_item(self, semaphore, session, info, url=None, resolve_time=0.0, priority=0):
+        """
+        下载一个作品，同一个文件同时只下载一次
+        :param url: 作品所属的链接，记录在结果里，默认为作品的下载地址
+        :param resolve_time: 解析该链接的耗时，记录在结果里
+        :param priority: 带宽调度的优先级，见 BandwidthScheduler.flow
+        :return: Result
+        """
+        return await self.flight.do(info["filepath"], self.download_file, semaphore, session, info,
+                                    url or info["url"], resolve_time, priority)
+
+    async def download_file(self, semaphore, session, info, url, resolve_time, priority):
+        # aiohttp 导入较慢，真正下载时才导入，只查询任务状态时不用等
+        from aiohttp import ClientError, ClientResponseError
+        from utils.transfer import fetch_resumable, fetch_segmented
+
+        if self.dedup is not None:
+            # 同一个链接已经下载过，不发请求，直接链接到已有文件
+            known = self.dedup.lookup(info["url"])
+            if known and self.dedup.link(known, info["filepath"]):
+                self.file_no_index.release(info["filepath"])
+                metrics.inc("dedup_total", result="url")
+                return Result(url, info["filepath"], resolve_time=resolve_time)
+
         await asyncio.sleep(0.2)
         async with self.lock:
             print("正在下载:", info["truncate_name"])
 
+        flow = bandwidth.flow(info["url"], priority)
+
+        async def attempt():
+            hasher = new_hasher() if self.dedup is not None else None
+            with metrics.timer("stage_seconds", stage="download"):
+                if info.get("segmented"):
+                    # 视频文件较大，多连接分段下载
+                    await fetch_segmented(session, info["url"], info["filepath"], self.timeout,
+                                          self.segments, self.min_segment_size, self.sink_options, hasher, flow)
+                else:
+                    await fetch_resumable(session, info["url"], info["filepath"], self.timeout, self.sink_options,
+                                          hasher, flow)
+            if hasher is not None:
+                # 内容与已有文件重复时替换为链接
+                self.dedup.add(info["url"], info["filepath"], hasher.hexdigest())
+            return info["filepath"]
+
         async with semaphore:
-            for rep in range(1, self.rep_count + 1):
-                try:
-                    async with session.request(method="GET", url=URL(info["url"], encoded=True),
-                                               timeout=self.timeout) as resp:
-                        if resp.status == 200:
-                            async with aiofiles.open(info["filepath"], mode="wb") as f:
-                                async for b in resp.content.iter_chunked(1024 * 1024):
-                                    if b:
-                                        await f.write(b)
-                            if os.path.isfile(info["filepath"]) and os.path.getsize(info["filepath"]) > 0:
-                                return info["filepath"]
-                            else:
-                                return "[{}] 下载失败~".format(info["truncate_name"])
-                        else:
-                            print("[{}] 请求失败:".format(info["truncate_name"], resp.status))
-                            print("重试中...{}/{}".format(rep, self.rep_count))
-                except (ClientError, ConnectionTimeoutError, ClientConnectorError) as e:
-                    print("[{}] 下载文件时出错\n:{}".format(info["truncate_name"], e))
-                    print("等待 2 秒后重试...{}/{}".format(rep, self.rep_count))
-                    await asyncio.sleep(2)  # 延迟后重试
-                except TimeoutError as e:
-                    print("[{}] 下载文件时超时\n:{}".format(info["truncate_name"], repr(e)))
-                    print("等待 2 秒后重试...{}/{}".format(rep, self.rep_count))
-                    await asyncio.sleep(2)  # 延迟后重试
-                except Exception as e:
-                    print("[{}] 其它异常\n:{}".format(info["truncate_name"], e))
-                    return "[{}] 下载异常~".format(info["truncate_name"])
-            else:
-                return "[{}] 下载失败~".format(info["truncate_name"])
+            start = time.perf_counter()
+            try:
+                with metrics.timer("stage_seconds", stage="download_total"):
+                    ret = await self.retry_policy.run(attempt, info["truncate_name"])
+                metrics.inc("items_total", stage="download", result="ok")
+                return Result(url, ret, resolve_time=resolve_time, download_time=time.perf_counter() - start)
+            except ClientResponseError as e:
+                print("[{}] 请求失败: {}".format(info["truncate_name"], e.status))
+                error = e
+            except (ClientError, TimeoutError) as e:
+                print("[{}] 下载文件时出错\n:{!r}".format(info["truncate_name"], e))
+                error = e
+            except Exception as e:
+                metrics.inc("items_total", stage="download", result="error")
+                print("[{}] 其它异常\n:{}".format(info["truncate_name"], e))
+                return Result.failed(url, e, message="[{}] 下载异常~".format(info["truncate_name"]),
+                                     resolve_time=resolve_time, download_time=time.perf_counter() - start)
+            metrics.inc("items_total", stage="download", result="failed")
+            return Result.failed(url, error, message="[{}] 下载失败~".format(info["truncate_name"]),
+                                 resolve_time=resolve_time, download_time=time.perf_counter() - start)
 
     async def client(self, text: str):
         semaphore = asyncio.Semaphore(10)
-        async with aiohttp.ClientSession() as session:
-            response = await self.get_pic_vid(session, text)
+        async with metrics.run(), self.session_factory.open() as sessions:
+            response = await self.get_pic_vid(sessions.resolver, text)
 
             data_list = self.data_parse(response)
             totals = len(data_list)
             suc_num = 1
             print("[*] 待下载任务:[{}]".format(totals))
 
-            tasks = [asyncio.create_task(self.download(semaphore, session, **ts)) for ts in data_list]
+            tasks = [asyncio.create_task(self.download(semaphore, sessions.media, **ts)) for ts in data_list]
             for task in asyncio.as_completed(tasks):
                 ret = await task
                 print("[*] 已完成: [{}/{}] 下载路径:{}".format(suc_num, totals, ret))
                 suc_num += 1
 
+    async def run_link(self, semaphore, sessions, text, emit, priority=0):
+        """
+        下载一个链接下的所有作品并记录到任务清单，每个作品完成时以 Result 调用 emit（协程函数）
+        解析失败时只产出一个 error 为 resolve 的结果
+        :param priority: 带宽调度的优先级
+        :return: 上次已完成时不做任何处理，返回清单里记录的保存目录；否则返回 None
+        """
+        job = self.manifest.get(text)
+        if self.manifest.is_done(job):
+            return job["path"]
+
+        start = time.perf_counter()
+        known = job["meta"] if job else None
+        if known and job["state"] != FAILED and self.reserve_known(known, text):
+            # 上次已经解析过，沿用当时的解析结果和文件名，不再重新编号
+            data_list = known
+        else:
+            # 失败的任务重新解析且不读缓存，上次的媒体链接可能已经过期；已分配的文件名沿用，
+            # 被其它链接占用的文件名重新分配
+            try:
+                response = await self.get_pic_vid(sessions.resolver, text, refresh=bool(known))
+                error = "无法获取链接信息"
+            except Exception as e:
+                response = None
+                error = "解析接口异常: {}".format(e)
+            data_list = self.data_parse(response, known, text) if response and response.get("data") else None
+            if response and response.get("data") and not data_list:
+                error = "解析数据失败"
+            if not data_list and known and self.reserve_known(known, text):
+                # 重新解析失败时退回上次的解析结果
+                data_list = known
+            if not data_list:
+                self.manifest.mark(text, FAILED, error=error)
+                await emit(Result.failed(text, error=RESOLVE, message=error,
+                                         resolve_time=time.perf_counter() - start))
+                return None
+            self.manifest.mark(text, RESOLVED, meta=data_list)
+        resolve_time = time.perf_counter() - start
+
+        errors = []
+
+        async def one(ts):
+            # 最终文件只会在下载完整后才出现（多进程时占位的是 .part 文件），存在说明上次已经下载完成
+            if os.path.isfile(ts["filepath"]) and os.path.getsize(ts["filepath"]):
+                result = Result(text, ts["filepath"], status=SKIPPED, resolve_time=resolve_time)
+            else:
+                result = await self.download_item(semaphore, sessions.media, ts, text, resolve_time, priority)
+            if not result.ok:
+                errors.append(result.message)
+            await emit(result)
+
+        await asyncio.gather(*(one(ts) for ts in data_list))
+        if errors:
+            self.manifest.mark(text, FAILED, error="; ".join(errors))
+        else:
+            self.manifest.mark(text, DOWNLOADED)
+            self.manifest.mark(text, DONE, path=os.path.dirname(data_list[0]["filepath"]))
+        return None
+
+    async def process_link(self, semaphore, sessions, text, priority=0):
+        """
+        下载一个链接下的所有作品，返回该链接的处理结果，results 为各作品的 Result（上次已完成时为一个 skipped 结果）
+        """
+        ret = {"url": text, "files": [], "errors": [], "skipped": False, "results": []}
+
+        async def collect(result):
+            ret["results"].append(result)
+            if not result.ok:
+                ret["errors"].append(result.message)
+            else:
+                ret["files"].append(result.path)
+
+        try:
+            self.manifest.add(text)
+            done = await self.run_link(semaphore, sessions, text, collect, priority)
+        except Exception as e:
+            # 解析结果缺字段、建目录失败、数据库被锁等意外错误只让这一个链接失败，不中断整批任务
+            message = "处理链接异常: {!r}".format(e)
+            print("[{}] {}".format(text, message))
+            ret["errors"].append(message)
+            ret["results"].append(Result.failed(text, e, message=message))
+            with contextlib.suppress(Exception):
+                self.manifest.mark(text, FAILED, error=message)
+            return ret
+        if done is not None:
+            ret["skipped"] = True
+            ret["results"].append(Result(text, done, status=SKIPPED))
+        return ret
+
+    async def iter_links(self, sessions, urls, priority=0):
+        """
+        批量处理链接：同时处理的链接数由 [pipeline] batch_workers 控制，同一时刻的相同链接只处理一次，
+        按完成顺序产出每个链接的 process_link 结果，调用方处理得慢时随之暂停
+        :param urls: 链接或分享文本的可迭代对象（也可以是异步可迭代对象，如 aiter_urls），按需读取
+        """
+        semaphore = asyncio.Semaphore(10)
+        out = asyncio.Queue(maxsize=self.batch_workers)
+
+        async def one(text):
+            await out.put(await self.link_flight.do(text, self.process_link, semaphore, sessions, text, priority))
+
+        async def texts():
+            # 异步的来源（如 aiter_urls）结束或提前退出时关闭，读取线程随之退出
+            if hasattr(urls, "__aiter__"):
+                try:
+                    async for text in urls:
+                        yield text
+                finally:
+                    if hasattr(urls, "aclose"):
+                        await urls.aclose()
+            else:
+                for text in urls:
+                    yield text
+
+        async def produce():
+            pending = set()
+            try:
+                async with contextlib.aclosing(texts()) as items:
+                    async for text in items:
+                        # 分享文本中取出作品链接，同一作品的不同写法归为同一个任务
+                        text = normalize_url(text)
+                        if not text:
+                            continue
+                        if len(pending) >= self.batch_workers:
+                            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        pending.add(asyncio.create_task(one(text)))
+                if pending:
+                    await asyncio.gather(*pending)
+            finally:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        # 显式关闭内层生成器，提前退出时在返回前就完成清理，而不是等垃圾回收
+        async with contextlib.aclosing(iter_results(produce(), out)) as results:
+            async for ret in results:
+                yield ret
+
+    async def stream(self, urls, priority=0):
+        """
+        逐个产出 Result：每个作品一个，解析失败的链接一个，上次已完成的链接一个（status 为 skipped）
+            async for result in Down().stream(urls):
+                ...
+        链接按完成顺序产出，同一链接的作品在该链接处理完后一起产出
+        :param urls: 链接或分享文本的可迭代对象，按需读取
+        :param priority: 带宽调度的优先级
+        """
+        async with self.session_factory.open() as sessions, \
+                contextlib.aclosing(self.iter_links(sessions, urls, priority)) as rets:
+            async for ret in rets:
+                for result in ret["results"]:
+                    yield result
+
+    @staticmethod
+    def new_summary():
+        return {"links": 0, "succeeded": 0, "failed": 0, "skipped": 0, "files": 0, "failures": []}
+
+    async def client_batch(self, urls):
+        """
+        批量下载：所有链接共用一个会话，同时处理的链接数由 [pipeline] batch_workers 控制
+        :param urls: 链接的可迭代对象或异步可迭代对象，按需读取
+        :return: 汇总信息
+        """
+        summary = self.new_summary()
+        async with metrics.run(), self.session_factory.open() as sessions:
+            async for ret in self.iter_links(sessions, urls):
+                summary["links"] += 1
+                if ret["skipped"]:
+                    summary["skipped"] += 1
+                    summary["succeeded"] += 1
+                    print("[*] 已完成: [{}] {} (上次已完成，跳过)".format(summary["links"], ret["url"]))
+                    continue
+                summary["files"] += len(ret["files"])
+                if ret["errors"]:
+                    summary["failed"] += 1
+                    summary["failures"].append({"url": ret["url"], "errors": ret["errors"]})
+                else:
+                    summary["succeeded"] += 1
+                print("[*] 已完成: [{}] {} 文件数:{} 失败数:{}".format(
+                    summary["links"], ret["url"], len(ret["files"]), len(ret["errors"])))
+        return summary
+
+    def batch(self, argv=None):
+        """
+        非交互的批量入口，进度输出到 stderr，最后在 stdout 输出一行 json 汇总
+        :return: 退出码，全部成功为 0，有失败为 1
+        """
+        parser = argparse.ArgumentParser(description="抖音、快手作品批量下载")
+        parser.add_argument("sources", nargs="*", help="链接列表：txt 文件、- 表示标准输入、或包含 txt 文件的目录")
+        parser.add_argument("--status", action="store_true", help="查看任务清单中各状态的数量和最近的失败")
+        parser.add_argument("--retry-failed", action="store_true", help="重新处理清单中失败或未完成的链接")
+        parser.add_argument("--dedup-index", nargs="+", metavar="DIR", help="把已有的下载目录登记进去重索引")
+        parser.add_argument("-p", "--processes", type=int, default=self.processes,
+                            help="进程数，大于 1 时按链接分片到多个进程并行下载")
+        args = parser.parse_args(argv)
+
+        if args.dedup_index:
+            if self.dedup is None:
+                parser.error("[dedup] 未开启")
+            files = added = 0
+            for folder in args.dedup_index:
+                num, new = self.dedup.index_folder(folder)
+                files += num
+                added += new
+            print(json.dumps({"files": files, "added": added}, ensure_ascii=False))
+            return 0
+        if args.status:
+            print(json.dumps(self.manifest.status(), ensure_ascii=False))
+            return 0
+        if args.retry_failed:
+            urls = self.manifest.iter_unfinished()
+        elif args.sources:
+            # 单进程时在后台线程中读取（标准输入可能很久才来一行），不阻塞正在进行的下载；
+            # 多进程时由主进程读取并写入分片文件，不在事件循环中
+            urls = self.iter_urls(args.sources) if args.processes > 1 else self.aiter_urls(args.sources)
+        else:
+            parser.error("需要指定链接来源，或使用 --status / --retry-failed")
+
+        with contextlib.redirect_stdout(sys.stderr):
+            if args.processes > 1:
+                summary = run_sharded(shard_worker, urls, args.processes, self.new_summary())
+            else:
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                summary = loop.run_until_complete(self.client_batch(urls))
+        print(json.dumps(summary, ensure_ascii=False))
+        return 1 if summary["failed"] else 0
+
     def main(self):
         text = input("请输入链接:")
         loop = asyncio.new_event_loop()
@@ -152,6 +466,22 @@ class Down(Utils):
         pass
 
 
+def shard_worker(index, path):
+    """
+    多进程分片运行时在子进程中处理一个分片文件，返回该分片的汇总
+    """
+    use_uvloop()
+    # 各进程可能往同一个目录写编号文件，分配编号时用占位文件在进程间互斥
+    Utils.file_no_index.exclusive = True
+    with contextlib.redirect_stdout(sys.stderr):
+        down = Down()
+        metrics.shard(index)
+        return asyncio.run(down.client_batch(down.iter_urls([path])))
+
+
 if __name__ == '__main__':
     down = Down()
+    if len(sys.argv) > 1:
+        # 带参数时批量下载：python dy_ks_request.py links.txt [- | dir ...]
+        sys.exit(down.batch(sys.argv[1:]))
     down.main()
@@ -4,7 +4,48 @@
 # @Author: jef.ld
 # @Project: dy_ks
 # @File: __init__.py
+import importlib
 
 from .utils import Utils
+from .file_index import FileNoIndex
+from .metrics import Metrics, metrics
 
-__all__ = ['Utils']
+# 以下对象所在模块会导入 aiohttp、sqlite3 等较重的依赖，第一次访问时再导入
+_lazy = {
+    "ResolverCache": ".cache",
+    "IncompleteDownloadError": ".transfer",
+    "fetch_resumable": ".transfer",
+    "fetch_segmented": ".transfer",
+    "TranscodePool": ".transcode",
+    "SessionFactory": ".session",
+    "Sessions": ".session",
+    "AdaptiveRateLimiter": ".ratelimit",
+    "Resolver": ".resolver",
+    "RetryPolicy": ".retry",
+    "RetryBudget": ".retry",
+    "RetryableError": ".retry",
+    "JobManifest": ".manifest",
+    "DedupStore": ".dedup",
+    "run_sharded": ".shard",
+    "normalize_url": ".links",
+    "SingleFlight": ".singleflight",
+    "FileSink": ".sink",
+    "SinkOptions": ".sink",
+    "Result": ".result",
+}
+
+
+def __getattr__(name):
+    module = _lazy.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+__all__ = ['Utils', 'FileNoIndex', 'Metrics', 'metrics', 'ResolverCache', 'IncompleteDownloadError', 'fetch_resumable',
+           'fetch_segmented', 'TranscodePool', 'SessionFactory', 'Sessions',
+           'AdaptiveRateLimiter', 'Resolver', 'RetryPolicy', 'RetryBudget', 'RetryableError', 'JobManifest',
+           'DedupStore', 'run_sharded', 'normalize_url', 'SingleFlight',
+           'FileSink', 'SinkOptions', 'Result']
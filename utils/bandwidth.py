@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import itertools
+import time
+from urllib.parse import urlsplit
+
+from .metrics import metrics
+
+
+class Bucket:
+    """
+    按字节计的令牌桶，允许透支：桶里有令牌（不少于 min(n, burst)）就放行 n 字节，
+    比桶容量还大的读取块也能通过，透支的部分由之后的等待补上
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, n):
+        """
+        :return: 还要等多少秒才能放行 n 字节，0 表示现在就可以
+        """
+        need = min(n, self.burst) - self.tokens
+        return need / self.rate if need > 0 else 0.0
+
+
+class Flow:
+    """
+    一个文件的传输，在 iter_chunked 的读取循环中每收到一块调用 consume
+    分段下载的各个连接共用同一个 Flow，整个文件只占一份带宽
+    """
+    __slots__ = ("scheduler", "host", "priority", "weight", "finish")
+
+    def __init__(self, scheduler, host, priority):
+        self.scheduler = scheduler
+        self.host = host
+        self.priority = priority
+        self.weight = 2.0 ** priority
+        self.finish = 0.0
+
+    def sized(self, length):
+        """
+        得知文件大小后调用，小文件提高一级优先级
+        """
+        small = self.scheduler.small_size
+        if length is not None and small and length <= small:
+            self.weight = 2.0 ** (self.priority + 1)
+
+    async def consume(self, n):
+        await self.scheduler.consume(self, n)
+
+
+class BandwidthScheduler:
+    """
+    全局共享的下载带宽调度，未设置速率时所有调用直接返回
+        全局和单个主机各有一个按字节计的令牌桶，同时满足两者才放行
+        排队的读取按加权公平排队（start-time fair queueing）的顺序放行：每个文件按权重 2 ** priority 分享带宽，
+        新开始的小文件不会排在大文件已经排好的数据后面；某个主机达到上限时，全局余量让给其它主机的传输
+    用法：
+        flow = bandwidth.flow(url, priority)
+        async for b in resp.content.iter_chunked(chunk_size):
+            await flow.consume(len(b))
+    """
+
+    def __init__(self):
+        self.rate = 0.0
+        self.host_rate = 0.0
+        self.burst = 0
+        self.small_size = 0
+        self.total = None
+        self.hosts = {}
+        self.waiters = []
+        self.seq = itertools.count()
+        self.vtime = 0.0
+        self.timer = None
+
+    def configure(self, config):
+        """
+        从 [bandwidth] 节点读取：rate、host_rate（字节/秒，0 表示不限）、burst（字节，0 表示一秒的量）、small_size
+        """
+        self.rate = config.getfloat("bandwidth", "rate", fallback=0)
+        self.host_rate = config.getfloat("bandwidth", "host_rate", fallback=0)
+        self.burst = config.getint("bandwidth", "burst", fallback=0)
+        self.small_size = config.getint("bandwidth", "small_size", fallback=1024 * 1024)
+        self.total = self.new_bucket(self.rate)
+        self.hosts = {}
+
+    @property
+    def enabled(self):
+        return self.rate > 0 or self.host_rate > 0
+
+    def new_bucket(self, rate):
+        if rate <= 0:
+            return None
+        return Bucket(rate, self.burst or rate)
+
+    def host_bucket(self, host):
+        if self.host_rate <= 0:
+            return None
+        bucket = self.hosts.get(host)
+        if bucket is None:
+            bucket = self.hosts[host] = self.new_bucket(self.host_rate)
+        return bucket
+
+    def flow(self, url, priority=0, length=None):
+        """
+        :param priority: 优先级，每高一级分到的带宽翻倍，可以为负数
+        :param length: 文件大小，已知时传入（之后得知也可以调用 Flow.sized）
+        """
+        flow = Flow(self, urlsplit(url).netloc, priority)
+        flow.sized(length)
+        return flow
+
+    def wait_time(self, host, n, now):
+        wait = 0.0
+        for bucket in (self.total, self.host_bucket(host)):
+            if bucket is not None:
+                bucket.refill(now)
+                wait = max(wait, bucket.wait(n))
+        return wait
+
+    def take(self, host, n):
+        for bucket in (self.total, self.host_bucket(host)):
+            if bucket is not None:
+                bucket.tokens -= n
+
+    async def consume(self, flow, n):
+        if not self.enabled or n <= 0:
+            return
+        # 每个 flow 的数据按虚拟时间排队：开始标签取系统虚拟时间和该 flow 上一块的结束标签中较大的
+        start = max(self.vtime, flow.finish)
+        flow.finish = start + n / flow.weight
+        if not self.waiters and not self.wait_time(flow.host, n, time.monotonic()):
+            self.vtime = start
+            self.take(flow.host, n)
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append((start, next(self.seq), flow, n, fut))
+        self.dispatch()
+        begin = time.perf_counter()
+        try:
+            await fut
+        finally:
+            if not fut.done():
+                # 被取消时从队列中移除，dispatch 会跳过已取消的 future
+                fut.cancel()
+                self.dispatch()
+        metrics.inc("bandwidth_wait_seconds", time.perf_counter() - begin)
+
+    def dispatch(self):
+        """
+        按开始标签从小到大放行所有现在就能放行的读取，剩下的在最早可放行的时刻再调度一次
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.waiters = [w for w in self.waiters if not w[4].done()]
+        self.waiters.sort(key=lambda w: w[:2])
+        now = time.monotonic()
+        delay = None
+        remaining = []
+        for waiter in self.waiters:
+            start, _, flow, n, fut = waiter
+            wait = self.wait_time(flow.host, n, now)
+            if wait:
+                remaining.append(waiter)
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            self.vtime = max(self.vtime, start)
+            self.take(flow.host, n)
+            fut.set_result(None)
+        self.waiters = remaining
+        if remaining:
+            self.timer = asyncio.get_running_loop().call_later(delay, self.dispatch)
+
+
+bandwidth = BandwidthScheduler()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+from .links import normalize_url
+from .sqlite_db import config_path, connect
+
+
+class ResolverCache:
+    """
+    解析接口（su.tuanyougou.com/query）返回结果的本地缓存
+    以规范化后的分享链接为 key，保存解析出的 json，支持过期时间、按最近访问淘汰和跳过读缓存
+    """
+
+    def __init__(self, filepath, ttl=86400, max_entries=100000, bypass=False):
+        """
+        :param filepath: sqlite 文件路径
+        :param ttl: 缓存有效期（秒），<=0 表示永不过期
+        :param max_entries: 最多保存的条数，超出后淘汰最久未访问的记录
+        :param bypass: 为 True 时不读缓存，但仍然写入最新结果
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bypass = bypass
+
+        self.conn = connect(filepath)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS resolver ("
+            "key TEXT PRIMARY KEY, data TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS resolver_accessed ON resolver (accessed)")
+        self.conn.commit()
+        self.count = self.conn.execute("SELECT COUNT(*) FROM resolver").fetchone()[0]
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        从配置文件的 [cache] 节点创建缓存，filepath 为相对路径时相对于项目根目录
+        """
+        filepath = config_path(config, "cache", "cache/resolver.sqlite3")
+        return cls(
+            filepath,
+            ttl=config.getint("cache", "ttl", fallback=86400),
+            max_entries=config.getint("cache", "max_entries", fallback=100000),
+            bypass=config.getboolean("cache", "bypass", fallback=False),
+        )
+
+    @staticmethod
+    def normalize(url):
+        return normalize_url(url)
+
+    def get(self, url):
+        if self.bypass:
+            return None
+        key = self.normalize(url)
+        row = self.conn.execute("SELECT data, created FROM resolver WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        now = time.time()
+        if 0 < self.ttl < now - row[1]:
+            self.conn.execute("DELETE FROM resolver WHERE key = ?", (key,))
+            self.conn.commit()
+            self.count -= 1
+            return None
+        self.conn.execute("UPDATE resolver SET accessed = ? WHERE key = ?", (now, key))
+        self.conn.commit()
+        return json.loads(row[0])
+
+    def set(self, url, data):
+        key = self.normalize(url)
+        now = time.time()
+        cur = self.conn.execute("UPDATE resolver SET data = ?, created = ?, accessed = ? WHERE key = ?",
+                                (json.dumps(data, ensure_ascii=False), now, now, key))
+        if cur.rowcount == 0:
+            self.conn.execute("INSERT INTO resolver (key, data, created, accessed) VALUES (?, ?, ?, ?)",
+                              (key, json.dumps(data, ensure_ascii=False), now, now))
+            self.count += 1
+        if self.count > self.max_entries:
+            self.evict(self.count - self.max_entries)
+        self.conn.commit()
+
+    def evict(self, num):
+        """
+        淘汰 num 条最久未访问的记录
+        """
+        self.conn.execute(
+            "DELETE FROM resolver WHERE key IN (SELECT key FROM resolver ORDER BY accessed LIMIT ?)", (num,)
+        )
+        self.count = self.conn.execute("SELECT COUNT(*) FROM resolver").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+import time
+
+from .metrics import metrics
+from .sqlite_db import config_path, connect
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # Linux ioctl，btrfs/xfs 等文件系统上的写时复制克隆
+
+MEDIA_EXTS = (".mp4", ".mp3", ".m4a", ".png", ".jpg", ".jpeg", ".webp", ".gif")
+
+
+def new_hasher():
+    return hashlib.sha256()
+
+
+def hash_file(filepath, hasher=None, chunk_size=1024 * 1024, length=None):
+    """
+    把文件的内容（length 不为 None 时只取前 length 字节）喂给 hasher（默认新建一个 sha256），返回 hasher
+    """
+    hasher = hasher or new_hasher()
+    remaining = length
+    with open(filepath, mode="rb") as f:
+        while remaining is None or remaining > 0:
+            b = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not b:
+                break
+            hasher.update(b)
+            if remaining is not None:
+                remaining -= len(b)
+    return hasher
+
+
+def reflink(src, dst):
+    with open(src, mode="rb") as s, open(dst, mode="wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class DedupStore:
+    """
+    按内容寻址的去重索引（SQLite WAL）
+        urls:  来源链接 -> (摘要, 保存路径)，下载前命中的链接直接复用已有文件，不再发请求
+        blobs: 内容摘要 -> 第一次保存的路径，下载完发现内容重复时，新文件改为指向已有文件的硬链接/reflink
+    """
+
+    def __init__(self, filepath, link="hardlink"):
+        """
+        :param filepath: sqlite 文件路径
+        :param link: 重复文件的链接方式：hardlink、reflink（不支持时退回硬链接）或 copy（不去重磁盘空间）
+        """
+        self.link_mode = link
+        self.conn = connect(filepath)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL, path TEXT NOT NULL, "
+            "updated REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        从 [dedup] 节点创建，enabled 为 false 时返回 None
+        """
+        if not config.getboolean("dedup", "enabled", fallback=True):
+            return None
+        filepath = config_path(config, "dedup", "cache/dedup.sqlite3")
+        return cls(filepath, link=config.get("dedup", "link", fallback="hardlink"))
+
+    @staticmethod
+    def normalize(url):
+        return url.strip()
+
+    def lookup(self, url):
+        """
+        :return: 该链接已经下载过且文件还在时返回保存路径，否则返回 None
+        """
+        row = self.conn.execute("SELECT path FROM urls WHERE url = ?", (self.normalize(url),)).fetchone()
+        if row is not None and os.path.isfile(row[0]):
+            return row[0]
+        return None
+
+    def link(self, src, dst):
+        """
+        让 dst 指向与 src 相同的内容，先链接到临时文件再原子替换
+        :return: 成功时返回 True，链接和复制都失败时返回 False（dst 保持原样）
+        """
+        if os.path.abspath(src) == os.path.abspath(dst):
+            return True
+        tmp = dst + ".link"
+        modes = {"reflink": ("reflink", "hardlink", "copy"), "copy": ("copy",)}.get(self.link_mode,
+                                                                                   ("hardlink", "copy"))
+        for mode in modes:
+            try:
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+                if mode == "reflink":
+                    if fcntl is None:
+                        continue
+                    reflink(src, tmp)
+                elif mode == "hardlink":
+                    os.link(src, tmp)
+                else:
+                    shutil.copyfile(src, tmp)
+                os.replace(tmp, dst)
+                return True
+            except OSError:
+                continue
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        return False
+
+    def add(self, url, filepath, digest):
+        """
+        登记一个刚下载完成的文件：内容已存在时把 filepath 替换为指向已有文件的链接
+        :return: 内容重复时返回 True
+        """
+        now = time.time()
+        size = os.path.getsize(filepath)
+        row = self.conn.execute("SELECT path, size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        duplicate = False
+        if row is not None and row[0] != filepath and os.path.isfile(row[0]) and os.path.getsize(row[0]) == size:
+            duplicate = self.link(row[0], filepath)
+        elif row is None or not os.path.isfile(row[0]):
+            self.conn.execute("INSERT OR REPLACE INTO blobs (digest, path, size) VALUES (?, ?, ?)",
+                              (digest, filepath, size))
+        if url:
+            self.conn.execute("INSERT OR REPLACE INTO urls (url, digest, path, updated) VALUES (?, ?, ?, ?)",
+                              (self.normalize(url), digest, filepath, now))
+        self.conn.commit()
+        metrics.inc("dedup_total", result="duplicate" if duplicate else "new")
+        return duplicate
+
+    def index_folder(self, root, exts=MEDIA_EXTS):
+        """
+        一次性把已有的下载目录登记进内容索引，之后新下载的重复内容会链接到这些文件
+        重复的已有文件只登记不改动
+        :return: (扫描的文件数, 新登记的内容数)
+        """
+        files = added = 0
+        for dirpath, _, names in os.walk(root):
+            for name in names:
+                if not name.lower().endswith(exts):
+                    continue
+                filepath = os.path.join(dirpath, name)
+                digest = hash_file(filepath).hexdigest()
+                cur = self.conn.execute("INSERT OR IGNORE INTO blobs (digest, path, size) VALUES (?, ?, ?)",
+                                        (digest, filepath, os.path.getsize(filepath)))
+                files += 1
+                added += cur.rowcount
+                if files % 1000 == 0:
+                    self.conn.commit()
+        self.conn.commit()
+        return files, added
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import threading
+
+
+class FileNoIndex:
+    """
+    编号文件名（file_00001.png）的分配索引
+    每个目录只在第一次使用时扫描一遍，之后在内存中记录已占用的编号，分配时只需要 O(1)
+    分配出去的编号立即视为占用，同一进程内的并发任务不会拿到重复的文件名；
+    分配前会再确认一次文件（或它的 .part 续传文件）是否已存在，运行过程中新出现的文件也不会被覆盖
+    多进程同时写同一个目录时打开 exclusive：分配的同时用 O_EXCL 创建空的 .part 文件作为占位，
+    创建失败说明编号已被其它进程占用，继续找下一个；下载就是写入这个 .part 文件，完成后原子重命名为真正的文件，
+    下载失败时 .part 保留续传数据，编号留给同一个任务重试，不会出现空的最终文件
+    分配时可以传入占用者（链接）和额外视为已占用的路径（任务清单里其它任务已分配、还没落盘的文件名）；
+    沿用上次的文件名时用 reserve_exact 重新登记，本次运行中已被其它链接占用时返回 False，由调用方重新分配
+    """
+
+    def __init__(self, exclusive=False):
+        self.exclusive = exclusive
+        self.lock = threading.Lock()
+        # 目录 -> {(去掉编号的文件名, 扩展名): {"used": 已占用编号, "low": 可能空闲的最小编号}}
+        self.dirs = {}
+        # 完整路径 -> 占用者，只记录分配时给出了占用者的文件
+        self.owners = {}
+
+    @staticmethod
+    def split_no(filename):
+        """
+        file_00001.png -> ("file", ".png", 1)；没有编号时编号为 None
+        """
+        stem, ext = os.path.splitext(filename)
+        m = re.search("_([0-9]{5})$", stem)
+        if m is None:
+            return stem, ext, None
+        return stem[:-6], ext, int(m.group(1))
+
+    def load(self, dirpath):
+        groups = {}
+        for f in os.scandir(dirpath):
+            if not f.is_file():
+                continue
+            stem, ext, no = self.split_no(f.name)
+            if no is not None:
+                groups.setdefault((stem, ext), {"used": set(), "low": 1})["used"].add(no)
+        self.dirs[dirpath] = groups
+        return groups
+
+    def group(self, dirpath, stem, ext):
+        groups = self.dirs.get(dirpath)
+        if groups is None:
+            groups = self.load(dirpath)
+        return groups.setdefault((stem, ext), {"used": set(), "low": 1})
+
+    def reserve(self, dirpath, filename, owner=None, held=()):
+        """
+        为 filename 分配一个编号：filename 自带编号且未被占用时直接使用，否则使用最小的空闲编号
+        :param owner: 占用者（例如链接），之后 reserve_exact 据此判断文件名是否已被其它链接占用
+        :param held: 额外视为已占用的完整路径
+        :return: (文件名, 编号)
+        """
+        dirpath = os.path.abspath(dirpath)
+        stem, ext, no = self.split_no(filename)
+
+        def taken(no):
+            return no in used or os.path.join(dirpath, self.make_name(stem, ext, no)) in held or \
+                self.exists(dirpath, stem, ext, no) or not self.claim(dirpath, stem, ext, no)
+
+        with self.lock:
+            group = self.group(dirpath, stem, ext)
+            used = group["used"]
+            if no is None or taken(no):
+                if no is not None:
+                    used.add(no)
+                no = group["low"]
+                while taken(no):
+                    used.add(no)
+                    no += 1
+                group["low"] = no + 1
+            used.add(no)
+            name = self.make_name(stem, ext, no)
+            if owner is not None:
+                self.owners[os.path.join(dirpath, name)] = owner
+            return name, no
+
+    def reserve_exact(self, filepath, owner):
+        """
+        沿用之前分配给 owner 的文件名（例如任务清单里记录的）：
+        本次运行中已被其它链接占用，或 exclusive 时抢不到 .part 占位，返回 False，调用方应重新分配；
+        磁盘上已有的文件和 .part 视为 owner 上次留下的
+        :return: 是否可以继续使用该文件名
+        """
+        filepath = os.path.abspath(filepath)
+        dirpath, filename = os.path.split(filepath)
+        stem, ext, no = self.split_no(filename)
+        with self.lock:
+            if self.owners.get(filepath, owner) != owner:
+                return False
+            if self.exclusive and not self.on_disk(filepath) and not self.claim_path(filepath):
+                return False
+            if no is not None and os.path.isdir(dirpath):
+                self.group(dirpath, stem, ext)["used"].add(no)
+            self.owners[filepath] = owner
+            return True
+
+    @staticmethod
+    def make_name(stem, ext, no):
+        return stem + "_%05d" % no + ext
+
+    @staticmethod
+    def on_disk(filepath):
+        """
+        文件本身、下载中的 .part 或待转码的 .src 任一存在都说明该文件名已被使用
+        """
+        return any(os.path.exists(filepath + suffix) for suffix in ("", ".part", ".src"))
+
+    def exists(self, dirpath, stem, ext, no):
+        return self.on_disk(os.path.join(dirpath, self.make_name(stem, ext, no)))
+
+    def claim(self, dirpath, stem, ext, no):
+        """
+        exclusive 时创建空的 .part 占位文件，返回是否抢到了这个编号
+        """
+        return self.claim_path(os.path.join(dirpath, self.make_name(stem, ext, no)))
+
+    def claim_path(self, filepath):
+        """
+        exclusive 时用 O_EXCL 创建 filepath.part 占位，返回是否抢到；不是 exclusive 时总是返回 True
+        """
+        if not self.exclusive:
+            return True
+        try:
+            os.close(os.open(filepath + ".part", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except FileExistsError:
+            return False
+        return True
+
+    @staticmethod
+    def release(filepath):
+        """
+        文件没有经过下载就已经得到（例如去重时直接链接到已有文件）时删除空的 .part 占位文件
+        """
+        part = filepath + ".part"
+        try:
+            if os.path.getsize(part) == 0 and not os.path.exists(part + ".json"):
+                os.remove(part)
+        except OSError:
+            pass
+
+    def forget(self, dirpath):
+        """
+        丢弃某个目录的索引，下次使用时重新扫描
+        """
+        with self.lock:
+            self.dirs.pop(os.path.abspath(dirpath), None)
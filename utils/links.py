@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# 分享文本里的链接：到空白、中文或中文标点为止
+URL_RE = re.compile(r"https?://[^\s\u3000-\u303f\u4e00-\u9fff\uff00-\uffef\"'<>]+", re.I)
+
+# 抖音、快手的主机，这些链接只保留能定位作品的参数
+SITE_HOSTS = ("douyin.com", "iesdouyin.com", "kuaishou.com", "chenzhongtech.com", "gifshow.com")
+SITE_PARAMS = {"modal_id", "vid", "aweme_id", "photoId"}
+
+# 其它链接去掉的跟踪参数
+TRACKING_PARAMS = {"share_token", "share_id", "shareId", "shareToken", "share_sign", "u_code", "timestamp",
+                   "utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content"}
+
+
+def extract_url(text):
+    """
+    从分享文本（"复制打开抖音…https://v.douyin.com/xxx/ …"）中取出第一个链接，没有链接时返回 None
+    """
+    m = URL_RE.search(text or "")
+    if m is None:
+        return None
+    return m.group(0).rstrip(".,;!?)]}")
+
+
+def is_site(host):
+    return any(host == h or host.endswith("." + h) for h in SITE_HOSTS)
+
+
+def normalize_url(text):
+    """
+    把一行输入规范成唯一的作品链接：取出分享文本里的链接，主机名小写，去掉锚点和跟踪参数，
+    同一个作品的不同分享方式得到同一个结果；没有链接时返回去掉首尾空白的原文
+    """
+    url = extract_url(text)
+    if url is None:
+        return (text or "").strip()
+
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    if is_site(host.split(":")[0]):
+        query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k in SITE_PARAMS]
+    else:
+        query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in TRACKING_PARAMS]
+    path = parts.path or "/"
+    return urlunsplit((parts.scheme.lower(), host, path, urlencode(sorted(query)), ""))
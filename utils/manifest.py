@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+from .links import normalize_url
+from .sqlite_db import config_path, connect
+
+# 任务状态：pending -> resolved -> downloaded/transcoded -> done，任一步失败为 failed
+PENDING = "pending"
+RESOLVED = "resolved"
+DOWNLOADED = "downloaded"
+TRANSCODED = "transcoded"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobManifest:
+    """
+    批量任务清单（SQLite WAL），按输入链接记录每个任务的状态、解析结果和最终路径
+    进程中途退出后重新运行时，已完成的任务直接跳过，已解析的任务不再请求解析接口，
+    只重新处理失败或未完成的任务
+    """
+
+    def __init__(self, filepath, kind):
+        """
+        :param filepath: sqlite 文件路径
+        :param kind: 任务类型，Down 和 DouyinDownloader 共用一个文件时用来区分
+        """
+        self.kind = kind
+        self.held = None
+        self.conn = connect(filepath)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "kind TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "meta TEXT, path TEXT, error TEXT, updated REAL NOT NULL, PRIMARY KEY (kind, key))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (kind, state)")
+        self.conn.commit()
+
+    @classmethod
+    def from_config(cls, config, kind):
+        filepath = config_path(config, "manifest", "cache/jobs.sqlite3")
+        return cls(filepath, kind)
+
+    @staticmethod
+    def normalize(url):
+        return normalize_url(url)
+
+    def get(self, url):
+        row = self.conn.execute(
+            "SELECT state, attempts, meta, path, error FROM jobs WHERE kind = ? AND key = ?",
+            (self.kind, self.normalize(url))
+        ).fetchone()
+        if row is None:
+            return None
+        return {"state": row[0], "attempts": row[1], "meta": json.loads(row[2]) if row[2] else None,
+                "path": row[3], "error": row[4]}
+
+    def is_done(self, job):
+        """
+        已完成且文件还在（Down 的作品可能有多个文件，记录在 path 里的是目录）
+        """
+        return job is not None and job["state"] == DONE and bool(job["path"]) and os.path.exists(job["path"])
+
+    def add(self, url):
+        """
+        登记一个任务，已存在时不改动
+        """
+        self.conn.execute("INSERT OR IGNORE INTO jobs (kind, key, state, updated) VALUES (?, ?, ?, ?)",
+                          (self.kind, self.normalize(url), PENDING, time.time()))
+        self.conn.commit()
+
+    def mark(self, url, state, meta=None, path=None, error=None):
+        """
+        更新任务状态，meta/path 为 None 时保留原值；进入 resolved 时尝试次数加一
+        """
+        self.conn.execute(
+            "INSERT INTO jobs (kind, key, state, attempts, meta, path, error, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (kind, key) DO UPDATE SET state = excluded.state, "
+            "attempts = attempts + (excluded.state = 'resolved'), "
+            "meta = COALESCE(excluded.meta, meta), path = COALESCE(excluded.path, path), "
+            "error = excluded.error, updated = excluded.updated",
+            (self.kind, self.normalize(url), state, int(state == RESOLVED),
+             json.dumps(meta, ensure_ascii=False) if meta is not None else None, path, error, time.time())
+        )
+        self.conn.commit()
+
+    def status(self, limit=20):
+        """
+        各状态的任务数，以及最近失败的任务
+        """
+        counts = dict(self.conn.execute(
+            "SELECT state, COUNT(*) FROM jobs WHERE kind = ? GROUP BY state", (self.kind,)
+        ).fetchall())
+        failures = [
+            {"url": key, "attempts": attempts, "error": error}
+            for key, attempts, error in self.conn.execute(
+                "SELECT key, attempts, error FROM jobs WHERE kind = ? AND state = ? ORDER BY updated DESC LIMIT ?",
+                (self.kind, FAILED, limit)
+            )
+        ]
+        return {"counts": counts, "failures": failures}
+
+    def iter_unfinished(self):
+        """
+        所有未完成的任务（失败或中途中断的），用于重新入队
+        """
+        last = 0
+        while True:
+            # 分页读取，任务很多时也不会一次性读进内存
+            rows = self.conn.execute(
+                "SELECT rowid, key FROM jobs WHERE kind = ? AND state != ? AND rowid > ? ORDER BY rowid LIMIT 1000",
+                (self.kind, DONE, last)
+            ).fetchall()
+            if not rows:
+                return
+            for last, key in rows:
+                yield key
+
+    def held_paths(self):
+        """
+        未完成的任务在解析时已经分配、可能还没有落盘的保存路径（解析结果里的 filepath），分配新文件名时视为已占用
+        第一次调用时分页读取一次，之后本次运行中新分配的文件名由调用方在内存中记录
+        """
+        if self.held is not None:
+            return self.held
+        held = set()
+        last = 0
+        while True:
+            rows = self.conn.execute(
+                "SELECT rowid, meta FROM jobs WHERE kind = ? AND state != ? AND meta IS NOT NULL AND rowid > ? "
+                "ORDER BY rowid LIMIT 1000",
+                (self.kind, DONE, last)
+            ).fetchall()
+            if not rows:
+                break
+            for last, meta in rows:
+                try:
+                    meta = json.loads(meta)
+                except ValueError:
+                    continue
+                # Down 记录的是作品列表，DouyinDownloader 是单个作品
+                for item in meta if isinstance(meta, list) else [meta]:
+                    if isinstance(item, dict) and item.get("filepath"):
+                        held.add(item["filepath"])
+        self.held = held
+        return held
+
+    def close(self):
+        self.conn.close()
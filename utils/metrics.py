@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+import bisect
+import contextlib
+import json
+import os
+import time
+
+# 耗时直方图的桶上界（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf"))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """
+        按桶估算分位数，返回所在桶的上界
+        落在最后一个不封顶的桶时返回最大的有限上界（即"至少这么多"），报告里不会出现 json 不支持的 Infinity
+        """
+        if not self.count:
+            return None
+        target = self.count * q
+        total = 0
+        for bound, num in zip(self.buckets, self.counts):
+            total += num
+            if total >= target:
+                break
+        if bound == float("inf"):
+            bound = max((b for b in self.buckets if b != float("inf")), default=None)
+        return bound
+
+
+class _Null:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL = _Null()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Metrics:
+    """
+    各阶段的计数器、耗时直方图和瞬时值，运行结束时输出 json 报告，可选输出 Prometheus 文本格式（文件或 HTTP）
+    未开启时所有记录方法直接返回，几乎没有额外开销
+    指标名：
+        stage_seconds{stage}      resolve/probe/download/transcode 单次尝试耗时，*_total 为包含重试的总耗时
+        items_total{stage,result} 各阶段完成数
+        bytes_total{stage}        接收字节数
+        write_seconds             写文件耗时
+        retries_total{kind,cause} 重试次数
+        resolver_cache_total{result} 解析缓存命中情况
+        source_total{key}         抖音音频最终选用的来源字段
+        dedup_total{result}       去重情况：url 命中已下载链接，duplicate 内容重复，new 新内容
+        queue_depth{queue}        流水线队列长度
+        singleflight_total{op,result} 相同请求合并情况：leader 实际执行，shared 共享结果
+        bandwidth_wait_seconds    因带宽限制等待的总时长
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.report_file = ""
+        self.prometheus_file = ""
+        self.prometheus_port = 0
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def configure(self, config):
+        self.enabled = config.getboolean("metrics", "enabled", fallback=False)
+        self.report_file = config.get("metrics", "report", fallback="")
+        self.prometheus_file = config.get("metrics", "prometheus_file", fallback="")
+        self.prometheus_port = config.getint("metrics", "prometheus_port", fallback=0)
+
+    def shard(self, index):
+        """
+        多进程分片运行时每个子进程单独输出：报告文件名加上分片编号，HTTP 端口依次加一
+        """
+        def suffix(filepath):
+            if not filepath:
+                return filepath
+            root, ext = os.path.splitext(filepath)
+            return "{}.{}{}".format(root, index, ext)
+
+        self.report_file = suffix(self.report_file)
+        self.prometheus_file = suffix(self.prometheus_file)
+        if self.prometheus_port:
+            self.prometheus_port += index
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(value)
+
+    def gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        current = self.gauges.get(key)
+        self.gauges[key] = (value, max(value, current[1]) if current else value)
+
+    def timer(self, name, **labels):
+        """
+        with metrics.timer("stage_seconds", stage="download"): ...
+        """
+        if not self.enabled:
+            return _NULL
+        return _Timer(self, name, labels)
+
+    @staticmethod
+    def label_str(labels):
+        return ",".join("{}={}".format(k, v) for k, v in labels)
+
+    def report(self):
+        elapsed = time.time() - self.started
+        received = sum(v for (name, _), v in self.counters.items() if name == "bytes_total")
+        return {
+            "elapsed": round(elapsed, 3),
+            "bytes_per_second": round(received / elapsed, 1) if elapsed > 0 else 0,
+            "counters": {"{}{{{}}}".format(name, self.label_str(labels)): v
+                         for (name, labels), v in sorted(self.counters.items())},
+            "histograms": {
+                "{}{{{}}}".format(name, self.label_str(labels)): {
+                    "count": h.count,
+                    "sum": round(h.sum, 6),
+                    "p50": h.percentile(0.5),
+                    "p90": h.percentile(0.9),
+                    "p99": h.percentile(0.99),
+                } for (name, labels), h in sorted(self.histograms.items())
+            },
+            "gauges": {"{}{{{}}}".format(name, self.label_str(labels)): {"last": v[0], "max": v[1]}
+                       for (name, labels), v in sorted(self.gauges.items())},
+        }
+
+    def prometheus(self):
+        """
+        Prometheus 文本格式
+        """
+        def fmt(name, labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return "dy_ks_" + name
+            return "dy_ks_{}{{{}}}".format(name, ",".join('{}="{}"'.format(k, v) for k, v in items))
+
+        lines = []
+        for (name, labels), v in sorted(self.counters.items()):
+            lines.append("{} {}".format(fmt(name, labels), v))
+        for (name, labels), h in sorted(self.histograms.items()):
+            total = 0
+            for bound, num in zip(h.buckets, h.counts):
+                total += num
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append("{} {}".format(fmt(name + "_bucket", labels, [("le", le)]), total))
+            lines.append("{} {}".format(fmt(name + "_sum", labels), h.sum))
+            lines.append("{} {}".format(fmt(name + "_count", labels), h.count))
+        for (name, labels), v in sorted(self.gauges.items()):
+            lines.append("{} {}".format(fmt(name, labels), v[0]))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def write(filepath, content):
+        folder = os.path.dirname(filepath)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(filepath, mode="w", encoding="utf-8") as f:
+            f.write(content)
+
+    def dump(self):
+        """
+        输出运行报告：json 报告写入 report 配置的文件（未配置时打印），Prometheus 文本写入 prometheus_file
+        """
+        if not self.enabled:
+            return
+        report = json.dumps(self.report(), ensure_ascii=False, indent=2)
+        if self.report_file:
+            self.write(self.report_file, report)
+            print("[*] 运行指标已写入: {}".format(self.report_file))
+        else:
+            print(report)
+        if self.prometheus_file:
+            self.write(self.prometheus_file, self.prometheus())
+
+    @contextlib.asynccontextmanager
+    async def run(self):
+        """
+        包住一次完整的运行：配置了端口时提供 /metrics 接口，结束时输出报告
+        """
+        self.reset()
+        runner = None
+        if self.enabled and self.prometheus_port:
+            from aiohttp import web
+
+            async def handler(request):
+                return web.Response(text=self.prometheus(), content_type="text/plain")
+
+            app = web.Application()
+            app.router.add_get("/metrics", handler)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", self.prometheus_port).start()
+        try:
+            yield self
+        finally:
+            if runner is not None:
+                await runner.cleanup()
+            self.dump()
+
+
+# 整个进程共用一份指标
+metrics = Metrics()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+
+def parse_retry_after(value):
+    """
+    Retry-After 可以是秒数也可以是 HTTP 日期，返回需要等待的秒数，无法解析时返回 None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Slot:
+    """
+    一次请求占用的名额，请求结束前通过 observe 告知响应状态
+    """
+
+    def __init__(self):
+        self.observed = False
+        self.throttled = False
+        self.retry_after = None
+
+    def observe(self, status, headers=None):
+        self.observed = True
+        if status == 429 or status >= 500:
+            self.throttled = True
+            if headers is not None:
+                self.retry_after = parse_retry_after(headers.get("Retry-After"))
+
+
+class HostLimiter:
+    """
+    单个主机的限速：令牌桶控制每秒请求数，AIMD 调整并发窗口
+    成功时窗口加性增长（每个窗口的请求全部成功大约 +1），429/5xx/超时时窗口减半，并遵守 Retry-After
+    rate <= 0 时不限制每秒请求数，只保留并发窗口（与 [bandwidth] 中 0 表示不限一致）
+    """
+
+    def __init__(self, rate, burst, min_limit, max_limit, initial, cooldown=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial)
+        self.cooldown = cooldown
+        self.active = 0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.cond = asyncio.Condition()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.cond:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.active >= int(self.limit):
+                    await self.cond.wait()
+                    continue
+                elif self.rate <= 0:
+                    self.active += 1
+                    return
+                else:
+                    self.refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.active += 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.cond.wait(), wait)
+
+    async def release(self, throttled, retry_after=None):
+        async with self.cond:
+            self.active -= 1
+            now = time.monotonic()
+            if throttled:
+                # 同一轮里连续失败只减一次，避免窗口一下子掉到底
+                if now - self.last_decrease >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.last_decrease = now
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+
+class AdaptiveRateLimiter:
+    """
+    按主机分别限速，用法：
+        async with limiter.slot(url) as slot:
+            async with session.request(...) as resp:
+                slot.observe(resp.status, resp.headers)
+    还没拿到响应就抛出异常（超时、连接错误等）也视为被限流
+    """
+
+    def __init__(self, rate=10.0, burst=10, min_concurrency=1, max_concurrency=16, initial_concurrency=4):
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = initial_concurrency
+        self.hosts = {}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            rate=config.getfloat("resolver", "rate", fallback=10.0),
+            burst=config.getint("resolver", "burst", fallback=10),
+            min_concurrency=config.getint("resolver", "min_concurrency", fallback=1),
+            max_concurrency=config.getint("resolver", "max_concurrency", fallback=16),
+            initial_concurrency=config.getint("resolver", "initial_concurrency", fallback=4),
+        )
+
+    def get(self, url):
+        host = urlsplit(url).netloc
+        limiter = self.hosts.get(host)
+        if limiter is None:
+            limiter = self.hosts[host] = HostLimiter(self.rate, self.burst, self.min_concurrency,
+                                                     self.max_concurrency, self.initial_concurrency)
+        return limiter
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url):
+        limiter = self.get(url)
+        await limiter.acquire()
+        slot = Slot()
+        try:
+            yield slot
+        except BaseException:
+            # 已经拿到响应的（如 404 后主动抛出）按响应状态算，否则视为超时/连接失败
+            if not slot.observed:
+                slot.throttled = True
+            raise
+        finally:
+            await limiter.release(slot.throttled, slot.retry_after)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+
+from .cache import ResolverCache
+from .links import normalize_url
+from .metrics import metrics
+from .ratelimit import AdaptiveRateLimiter
+from .retry import RetryPolicy
+from .singleflight import SingleFlight
+
+
+class Resolver:
+    """
+    解析接口客户端，get_audio_info 和 get_pic_vid 共用
+    先查本地缓存，未命中时经过按主机的自适应限速再请求接口，失败按重试策略重试
+    输入先规范成作品链接，同一个链接同时只请求一次，其它调用共享结果
+    """
+
+    def __init__(self, cache, limiter, policy, url="https://su.tuanyougou.com/query"):
+        self.cache = cache
+        self.limiter = limiter
+        self.policy = policy
+        self.url = url
+        self.flight = SingleFlight("resolve")
+
+    @classmethod
+    def from_config(cls, config, policy=None):
+        """
+        :param policy: 与媒体下载共用的 RetryPolicy，为 None 时按配置新建
+        """
+        return cls(ResolverCache.from_config(config), AdaptiveRateLimiter.from_config(config),
+                   policy or RetryPolicy.from_config(config),
+                   url=config.get("resolver", "url", fallback="https://su.tuanyougou.com/query"))
+
+    async def query(self, session, text, refresh=False):
+        """
+        :param text: 链接或包含链接的分享文本
+        :param refresh: 为 True 时不读缓存，重新请求接口（缓存的媒体链接可能已经过期）
+        :return: 接口返回的 json，请求失败时返回 None
+        """
+        text = normalize_url(text)
+        return await self.flight.do(("refresh", text) if refresh else text, self.fetch, session, text, refresh)
+
+    async def fetch(self, session, text, refresh=False):
+        data = None if refresh else self.cache.get(text)
+        if data is not None:
+            metrics.inc("resolver_cache_total", result="hit")
+            return data
+        metrics.inc("resolver_cache_total", result="bypass" if refresh else "miss")
+        # aiohttp 导入较慢，真正请求接口时才导入
+        from aiohttp import ClientError
+        from yarl import URL
+        from .transfer import raise_status
+
+        params = {
+            "url": text,
+            "token": "",
+            "id": "",
+            "user_id": "1"
+        }
+
+        async def attempt():
+            async with self.limiter.slot(self.url) as slot:
+                async with session.request(method="GET", url=URL(self.url, encoded=True), params=params) as resp:
+                    slot.observe(resp.status, resp.headers)
+                    if resp.status != 200:
+                        raise_status(resp)
+                    return json.loads(await resp.text())
+
+        try:
+            with metrics.timer("stage_seconds", stage="resolve"):
+                data = await self.policy.run(attempt, text)
+        except (ClientError, asyncio.TimeoutError, ValueError) as e:
+            metrics.inc("items_total", stage="resolve", result="failed")
+            print("[{}] 解析接口请求失败: {!r}".format(text, e))
+            return None
+        metrics.inc("items_total", stage="resolve", result="ok")
+        if data and data.get("data"):
+            self.cache.set(text, data)
+        return data
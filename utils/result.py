@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+
+from .retry import RetryableError, describe
+
+# 状态
+OK = "ok"
+FAILED = "failed"
+SKIPPED = "skipped"  # 上次已经完成，这次没有下载
+
+# 错误类型
+RESOLVE = "resolve"      # 解析接口失败或返回的数据无法解析
+HTTP = "http"            # 媒体请求返回了错误状态码
+NETWORK = "network"      # 连接中断、超时、数据不完整
+TRANSCODE = "transcode"  # ffmpeg 转码失败
+IO = "io"                # 写文件失败
+OTHER = "other"
+
+
+def error_kind(exc):
+    from aiohttp import ClientError, ClientResponseError
+
+    if isinstance(exc, ClientResponseError):
+        return HTTP
+    if isinstance(exc, (ClientError, asyncio.TimeoutError)):
+        return NETWORK
+    if isinstance(exc, RetryableError):
+        return TRANSCODE
+    if isinstance(exc, OSError):
+        return IO
+    return OTHER
+
+
+class Result:
+    """
+    一个作品的处理结果，stream() 按完成顺序产出
+    只有固定的几个字段（__slots__），百万级结果也只占很少内存
+        url       输入的链接（规范化之后）
+        path      保存路径，失败时为 None
+        bytes     文件大小
+        status    ok / failed / skipped
+        error     失败时的错误类型：resolve/http/network/transcode/io/other
+        message   失败原因
+        resolve_time / download_time / transcode_time  各阶段耗时（秒，包含重试）
+    """
+    __slots__ = ("url", "path", "bytes", "status", "error", "message", "resolve_time", "download_time",
+                 "transcode_time")
+
+    def __init__(self, url, path=None, status=OK, error=None, message=None, resolve_time=0.0, download_time=0.0,
+                 transcode_time=0.0):
+        self.url = url
+        self.path = path
+        self.bytes = os.path.getsize(path) if path and os.path.isfile(path) else 0
+        self.status = status
+        self.error = error
+        self.message = message
+        self.resolve_time = resolve_time
+        self.download_time = download_time
+        self.transcode_time = transcode_time
+
+    @classmethod
+    def failed(cls, url, exc=None, error=None, message=None, **kwargs):
+        """
+        由异常（或直接给出的错误类型和原因）构造失败结果
+        """
+        if exc is not None:
+            error = error or error_kind(exc)
+            message = message or describe(exc)
+        return cls(url, status=FAILED, error=error or OTHER, message=message, **kwargs)
+
+    @property
+    def ok(self):
+        return self.status != FAILED
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "Result({})".format(", ".join("{}={!r}".format(k, v) for k, v in self.to_dict().items()))
+
+
+async def iter_results(producer, out):
+    """
+    在后台运行 producer 协程，同时按放入的顺序产出它放进 out 队列的结果，producer 结束且队列取空后停止
+    out 是有界队列，调用方不取结果时 producer 会在 put 处等待（背压）；调用方提前退出时取消 producer
+    producer 抛出的异常在结果取完后重新抛出
+    """
+    task = asyncio.ensure_future(producer)
+    get = None
+    try:
+        while True:
+            get = asyncio.ensure_future(out.get())
+            await asyncio.wait((get, task), return_when=asyncio.FIRST_COMPLETED)
+            if not get.done():
+                get.cancel()
+                break
+            yield get.result()
+        while not out.empty():
+            yield out.get_nowait()
+        task.result()
+    finally:
+        if get is not None and not get.done():
+            get.cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
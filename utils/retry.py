@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import errno
+import random
+
+from .metrics import metrics
+from .ratelimit import parse_retry_after
+
+RETRYABLE = "retryable"  # 临时错误：网络中断、超时、5xx
+THROTTLED = "throttled"  # 被限流：429、503 带 Retry-After
+PERMANENT = "permanent"  # 重试也没用：403/404、磁盘写满、代码异常
+
+# 本地磁盘问题，重试也不会好
+_DISK_ERRNO = {errno.ENOSPC, errno.EACCES, errno.EROFS, errno.ENAMETOOLONG, getattr(errno, "EDQUOT", errno.ENOSPC)}
+
+
+class RetryableError(Exception):
+    """
+    调用方主动标记为可以重试的失败，例如 ffmpeg 转码失败
+    """
+
+
+def describe(exc):
+    """
+    简短的错误描述，ClientResponseError 的 repr 带着完整的请求信息，太长了
+    """
+    from aiohttp import ClientResponseError  # 只在出错时用到，不拖慢入口模块的导入
+
+    if isinstance(exc, ClientResponseError):
+        return "HTTP {} {}".format(exc.status, exc.message)
+    return repr(exc)
+
+
+class RetryBudget:
+    """
+    全局重试预算：每个新任务存入 ratio 个令牌，每次重试消耗 1 个
+    故障面大时重试次数被限制在正常请求量的一定比例内，避免重试放大流量
+    """
+
+    def __init__(self, ratio=0.2, reserve=20, max_tokens=100):
+        """
+        :param ratio: 每个新任务存入的令牌数
+        :param reserve: 初始令牌数
+        :param max_tokens: 令牌数上限
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(reserve)
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RetryPolicy:
+    """
+    解析接口与媒体下载共用的重试策略
+    先对失败分类（可重试/被限流/永久失败），永久失败立即放弃；
+    其余按指数退避加随机抖动等待，限流时至少等到 Retry-After，
+    同时受单个任务的截止时间和全局重试预算约束
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=30.0, deadline=900.0, budget=None):
+        """
+        :param max_attempts: 最多尝试次数（含第一次）
+        :param base_delay: 第一次重试的退避基数（秒）
+        :param max_delay: 单次退避上限（秒）
+        :param deadline: 单个任务从第一次请求开始的最长耗时（秒），<=0 表示不限制
+        :param budget: RetryBudget，为 None 时不限制重试总量
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.budget = budget
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            max_attempts=config.getint("retry", "max_attempts",
+                                       fallback=config.getint("options", "rep_count", fallback=5)),
+            base_delay=config.getfloat("retry", "base_delay", fallback=1.0),
+            max_delay=config.getfloat("retry", "max_delay", fallback=30.0),
+            deadline=config.getfloat("retry", "deadline", fallback=900.0),
+            budget=RetryBudget(
+                ratio=config.getfloat("retry", "budget_ratio", fallback=0.2),
+                reserve=config.getint("retry", "budget_reserve", fallback=20),
+                max_tokens=config.getint("retry", "budget_max", fallback=100),
+            ),
+        )
+
+    @staticmethod
+    def classify(exc):
+        """
+        :return: (分类, Retry-After 秒数)
+        """
+        from aiohttp import ClientError, ClientResponseError
+
+        if isinstance(exc, ClientResponseError):
+            retry_after = parse_retry_after(exc.headers.get("Retry-After")) if exc.headers else None
+            if exc.status == 429 or (exc.status == 503 and retry_after is not None):
+                return THROTTLED, retry_after
+            if exc.status == 408 or exc.status >= 500:
+                return RETRYABLE, retry_after
+            return PERMANENT, None
+        if isinstance(exc, (ClientError, asyncio.TimeoutError, RetryableError)):
+            return RETRYABLE, None
+        if isinstance(exc, OSError):
+            return (PERMANENT if exc.errno in _DISK_ERRNO else RETRYABLE), None
+        return PERMANENT, None
+
+    def backoff(self, attempt, kind, retry_after=None):
+        """
+        指数退避 + 全抖动：在 [0, min(max_delay, base * 2^(attempt-1))] 中随机取值
+        被限流时退避翻倍，且不短于 Retry-After
+        """
+        cap = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        if kind == THROTTLED:
+            cap = min(self.max_delay, cap * 2)
+        delay = random.uniform(0, cap)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def run(self, func, name=""):
+        """
+        执行 func（无参数的协程函数），按策略重试，最终失败时抛出最后一次的异常
+        """
+        from aiohttp import ClientResponseError
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline if self.deadline > 0 else None
+        if self.budget is not None:
+            self.budget.deposit()
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await func()
+            except Exception as e:
+                kind, retry_after = self.classify(e)
+                if kind == PERMANENT or attempt >= self.max_attempts:
+                    raise
+                delay = self.backoff(attempt, kind, retry_after)
+                if deadline is not None and loop.time() + delay > deadline:
+                    print("[{}] 超过任务截止时间，不再重试".format(name))
+                    raise
+                if self.budget is not None and not self.budget.withdraw():
+                    print("[{}] 重试预算已用完，不再重试".format(name))
+                    raise
+                metrics.inc("retries_total", kind=kind,
+                            cause="http_{}".format(e.status) if isinstance(e, ClientResponseError) else type(e).__name__)
+                print("[{}] {}: {}".format(name, "被限流" if kind == THROTTLED else "请求出错", describe(e)))
+                print("等待 {:.1f} 秒后重试...{}/{}".format(delay, attempt, self.max_attempts))
+                await asyncio.sleep(delay)
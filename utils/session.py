@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+
+class SessionFactory:
+    """
+    两个下载器共用的会话工厂
+    解析接口和媒体下载各用一个连接池，连接数分别限制，解析请求不会挤占媒体下载的连接；
+    开启 DNS 缓存并调整 keep-alive 时间，尽量复用已有连接
+    用法：
+        async with SessionFactory.from_config(config).open() as sessions:
+            sessions.resolver  # 请求解析接口
+            sessions.media     # 下载图片、视频、音频
+    """
+
+    def __init__(self, limit=100, limit_per_host=10, resolver_limit=20, resolver_limit_per_host=10,
+                 dns_ttl=300, keepalive_timeout=30):
+        """
+        :param limit: 媒体连接池的总连接数，0 表示不限制
+        :param limit_per_host: 媒体连接池中每个主机的连接数，0 表示不限制
+        :param resolver_limit: 解析接口连接池的总连接数
+        :param resolver_limit_per_host: 解析接口连接池中每个主机的连接数
+        :param dns_ttl: DNS 缓存时间（秒）
+        :param keepalive_timeout: 空闲连接保持时间（秒）
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.resolver_limit = resolver_limit
+        self.resolver_limit_per_host = resolver_limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            limit=config.getint("session", "limit", fallback=100),
+            limit_per_host=config.getint("session", "limit_per_host", fallback=10),
+            resolver_limit=config.getint("session", "resolver_limit", fallback=20),
+            resolver_limit_per_host=config.getint("session", "resolver_limit_per_host", fallback=10),
+            dns_ttl=config.getint("session", "dns_ttl", fallback=300),
+            keepalive_timeout=config.getint("session", "keepalive_timeout", fallback=30),
+        )
+
+    def create(self, limit, limit_per_host):
+        import aiohttp  # 创建会话时才导入，只读配置、查询任务状态时用不到
+
+        connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    def open(self):
+        """
+        创建一组新的会话，需要在事件循环中调用
+        """
+        return Sessions(
+            resolver=self.create(self.resolver_limit, self.resolver_limit_per_host),
+            media=self.create(self.limit, self.limit_per_host),
+        )
+
+
+class Sessions:
+    """
+    一组会话：resolver 用于解析接口，media 用于媒体下载
+    """
+
+    def __init__(self, resolver, media):
+        self.resolver = resolver
+        self.media = media
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        await self.resolver.close()
+        await self.media.close()
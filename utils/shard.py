@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import shutil
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from .links import normalize_url
+
+
+def use_uvloop():
+    """
+    安装了 uvloop 时使用 uvloop 的事件循环
+    :return: 是否启用了 uvloop
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def split(urls, processes, folder):
+    """
+    按规范化后链接的哈希把链接分到 processes 个分片文件里，同一个作品的不同分享写法总是落在同一个分片，
+    分片文件里写入的是规范化后的链接；逐行写入，内存占用与链接数无关
+    :return: 非空分片文件的路径列表
+    """
+    paths = [os.path.join(folder, "shard_%03d.txt" % i) for i in range(processes)]
+    counts = [0] * processes
+    files = [open(path, mode="w", encoding="utf-8") for path in paths]
+    try:
+        for url in urls:
+            url = normalize_url(url)
+            if not url:
+                continue
+            i = zlib.crc32(url.encode("utf-8")) % processes
+            files[i].write(url + "\n")
+            counts[i] += 1
+    finally:
+        for f in files:
+            f.close()
+    return [path for path, count in zip(paths, counts) if count]
+
+
+def merge(summaries, initial=None):
+    """
+    合并各分片的汇总：数值相加，列表拼接
+    :param initial: 汇总的初始值（各字段为 0 或空列表），没有分片时原样返回
+    """
+    merged = {key: list(value) if isinstance(value, list) else value for key, value in (initial or {}).items()}
+    for summary in summaries:
+        for key, value in summary.items():
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def run_sharded(worker, urls, processes, initial=None):
+    """
+    把链接分片后交给 processes 个子进程并行处理，每个子进程有自己的事件循环和会话
+    :param worker: 模块级函数 worker(index, path) -> 汇总 dict，在子进程中处理一个分片文件
+    :param urls: 链接的可迭代对象
+    :param initial: 汇总的初始值
+    :return: 合并后的汇总
+    """
+    folder = tempfile.mkdtemp(prefix="dy_ks_shards_")
+    try:
+        paths = split(urls, processes, folder)
+        if not paths:
+            return merge([], initial)
+        with ProcessPoolExecutor(max_workers=len(paths)) as pool:
+            return merge(pool.map(worker, range(len(paths)), paths), initial)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
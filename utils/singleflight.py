@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from .metrics import metrics
+
+
+class SingleFlight:
+    """
+    合并同一时刻的相同请求：key 相同的调用只执行一次，其余调用等待并共享同一个结果（或异常）
+    只合并正在进行的调用，执行完后 key 立即释放，之后的调用会重新执行
+    """
+
+    def __init__(self, name):
+        """
+        :param name: 用于指标 singleflight_total{op} 的名字
+        """
+        self.name = name
+        self.calls = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        call = self.calls.get(key)
+        if call is None:
+            fut = asyncio.ensure_future(func(*args, **kwargs))
+            # [共享的 future, 正在等待的调用方数]
+            call = self.calls[key] = [fut, 0]
+            fut.add_done_callback(lambda f: self.calls.pop(key, None) if self.calls.get(key, (None,))[0] is f else None)
+            metrics.inc("singleflight_total", op=self.name, result="leader")
+        else:
+            metrics.inc("singleflight_total", op=self.name, result="shared")
+        call[1] += 1
+        try:
+            # 某个调用方被取消时不影响其它等待同一结果的调用方
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            # 所有调用方都被取消（例如 stream() 提前退出）时取消这次调用，不在后台继续使用已关闭的会话
+            if not call[1] and not call[0].done():
+                call[0].cancel()
+                # 等它真正退出再返回，调用方随后关闭会话时不会还有请求在进行
+                await asyncio.wait((call[0],))
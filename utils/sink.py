@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+
+from .metrics import metrics
+
+FSYNC_MODES = ("none", "close", "periodic")
+
+
+def preallocate(fd, length):
+    try:
+        os.posix_fallocate(fd, 0, length)
+    except (AttributeError, OSError):
+        # macOS 等平台没有 posix_fallocate，至少把文件扩展到目标大小
+        os.ftruncate(fd, length)
+
+
+def fdatasync(fd):
+    # macOS 没有 fdatasync
+    getattr(os, "fdatasync", os.fsync)(fd)
+
+
+class SinkOptions:
+    """
+    写文件的参数，来自配置文件的 [io] 节点
+    """
+
+    def __init__(self, chunk_size=1024 * 1024, buffer_size=4 * 1024 * 1024, preallocate=True, fsync="none",
+                 fsync_interval=64 * 1024 * 1024):
+        """
+        :param chunk_size: 从响应中每次读取的字节数
+        :param buffer_size: 攒够多少字节写一次文件
+        :param preallocate: 知道文件大小时是否预分配磁盘空间
+        :param fsync: none 不主动落盘；close 关闭前落盘；periodic 每写入 fsync_interval 字节落盘一次，关闭前再落盘
+        :param fsync_interval: periodic 模式下的落盘间隔（字节）
+        """
+        if fsync not in FSYNC_MODES:
+            raise ValueError("fsync 只能是 {}: {}".format("/".join(FSYNC_MODES), fsync))
+        self.chunk_size = chunk_size
+        self.buffer_size = max(buffer_size, chunk_size)
+        self.preallocate = preallocate
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            chunk_size=config.getint("io", "chunk_size", fallback=1024 * 1024),
+            buffer_size=config.getint("io", "buffer_size", fallback=4 * 1024 * 1024),
+            preallocate=config.getboolean("io", "preallocate", fallback=True),
+            fsync=config.get("io", "fsync", fallback="none"),
+            fsync_interval=config.getint("io", "fsync_interval", fallback=64 * 1024 * 1024),
+        )
+
+
+class FileSink:
+    """
+    异步写文件：把网络上收到的小块攒成 buffer_size 的大块再写，每个大块只切换一次线程；
+    写入在后台进行，期间继续接收下一块（双缓冲），按偏移写入，多个分段可以各自打开一个 sink 写同一个文件
+    用法：
+        async with FileSink(part, offset=0, length=total, options=options) as sink:
+            async for b in resp.content.iter_chunked(options.chunk_size):
+                await sink.write(b)
+    出错退出时已收到的数据也会写入文件，written 为实际写到的位置
+    """
+
+    def __init__(self, filepath, offset=0, length=None, options=None, truncate=False, on_flush=None):
+        """
+        :param offset: 从文件的哪个位置开始写
+        :param length: 文件的最终大小，已知且开启预分配时预先分配磁盘空间
+        :param truncate: 打开时把文件截断到 offset（丢弃 offset 之后的旧数据或预分配的空间）
+        :param on_flush: 每次写入完成后以当前写到的位置调用，用于记录续传进度
+        """
+        self.filepath = filepath
+        self.options = options or SinkOptions()
+        self.length = length
+        self.truncate = truncate
+        self.on_flush = on_flush
+        self.written = offset
+        self.pos = offset
+        self.unsynced = 0
+        self.buffer = bytearray()
+        self.pending = None
+        self.fd = None
+
+    async def __aenter__(self):
+        self.fd = os.open(self.filepath, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if self.truncate:
+                os.ftruncate(self.fd, self.written)
+            if self.length and self.options.preallocate and self.length > self.written:
+                preallocate(self.fd, self.length)
+        except OSError:
+            os.close(self.fd)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+        return False
+
+    async def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.options.buffer_size:
+            await self.flush(wait=False)
+
+    def write_at(self, data, pos):
+        """
+        在线程池中执行：写入一整块，periodic 模式下累计到间隔时落盘
+        """
+        view = memoryview(data)
+        while view:
+            num = os.pwrite(self.fd, view, pos)
+            view = view[num:]
+            pos += num
+        self.unsynced += len(data)
+        if self.options.fsync == "periodic" and self.unsynced >= self.options.fsync_interval:
+            fdatasync(self.fd)
+            self.unsynced = 0
+
+    async def wait(self):
+        if self.pending is None:
+            return
+        future, end = self.pending
+        self.pending = None
+        with metrics.timer("write_seconds"):
+            await future
+        self.written = end
+        if self.on_flush is not None:
+            self.on_flush(self.written)
+
+    async def flush(self, wait=True):
+        """
+        把缓冲区交给线程池写入，wait=False 时不等这次写完（下次写入或关闭前再等）
+        """
+        await self.wait()
+        if self.buffer:
+            data, self.buffer = self.buffer, bytearray()
+            loop = asyncio.get_running_loop()
+            self.pending = (loop.run_in_executor(None, self.write_at, data, self.pos), self.pos + len(data))
+            self.pos += len(data)
+        if wait:
+            await self.wait()
+
+    async def close(self):
+        if self.fd is None:
+            return
+        try:
+            await self.flush()
+            if self.options.fsync != "none" and self.unsynced:
+                await asyncio.get_running_loop().run_in_executor(None, fdatasync, self.fd)
+        finally:
+            fd, self.fd = self.fd, None
+            os.close(fd)
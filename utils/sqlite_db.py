@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+
+from .utils import Utils
+
+
+def config_path(config, section, fallback):
+    """
+    读取 section 节点的 filepath，相对路径相对于项目根目录
+    """
+    filepath = config.get(section, "filepath", fallback=fallback)
+    if not os.path.isabs(filepath):
+        filepath = Utils.get_current_path(filepath=tuple(filepath.replace("\\", "/").split("/")))
+    return filepath
+
+
+def connect(filepath):
+    """
+    打开 sqlite 文件，目录不存在时先创建
+    使用 WAL，多个进程可以同时读写同一个文件，写锁最多等 30 秒；synchronous=NORMAL 在 WAL 下断电也不会损坏数据库
+    """
+    folder = os.path.dirname(filepath)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    conn = sqlite3.connect(filepath, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import re
+import subprocess
+from collections import deque
+
+
+class TranscodePool:
+    """
+    ffmpeg 转码调度：并发数默认等于 CPU 核数，与网络下载的并发相互独立
+    每个任务有超时时间，超时后杀掉 ffmpeg 进程；stderr 边读边丢，只保留最后几行用于报错
+    """
+
+    def __init__(self, workers=0, timeout=600, tail_lines=20, input_mode="spool"):
+        """
+        :param workers: 同时运行的 ffmpeg 进程数，<=0 表示使用 CPU 核数
+        :param timeout: 单个转码任务的超时时间（秒），<=0 表示不限制
+        :param tail_lines: 保留的 stderr 行数
+        :param input_mode: ffmpeg 的输入方式 url/pipe/spool，由下载器决定如何使用
+        """
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.timeout = timeout if timeout > 0 else None
+        self.tail_lines = tail_lines
+        self.input_mode = input_mode
+        self.semaphore = asyncio.Semaphore(self.workers)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            workers=config.getint("transcode", "workers", fallback=0),
+            timeout=config.getint("transcode", "timeout", fallback=600),
+            input_mode=config.get("transcode", "input", fallback="spool"),
+        )
+
+    @staticmethod
+    async def read_stderr(stream, tail):
+        """
+        按块读取 stderr，ffmpeg 的进度行用 \\r 分隔，所以同时按 \\r 和 \\n 切行
+        """
+        rest = b""
+        while True:
+            chunk = await stream.read(4096)
+            if not chunk:
+                break
+            lines = re.split(rb"[\r\n]", rest + chunk)
+            rest = lines.pop()
+            tail.extend(line.decode(errors="replace") for line in lines if line.strip())
+        if rest.strip():
+            tail.append(rest.decode(errors="replace"))
+
+    @staticmethod
+    async def feed_stdin(writer, source):
+        """
+        把异步字节迭代器的内容写入进程标准输入，写完后关闭 stdin 让 ffmpeg 收到 EOF
+        数据源抛出的异常（如网络中断）会继续向上抛出，由调用方终止进程
+        """
+        try:
+            async for chunk in source:
+                writer.write(chunk)
+                await writer.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg 已经提前退出，错误信息看 stderr
+        finally:
+            writer.close()
+
+    async def run(self, cmd, stdin=None):
+        """
+        运行一条 ffmpeg 命令
+        :param cmd: 命令参数列表
+        :param stdin: 可选的异步字节迭代器，内容会写入进程的标准输入（配合 -i pipe:0 使用）
+        :return: (returncode, stderr 最后几行)，超时被杀掉时 returncode 为 None
+        """
+        async with self.semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE
+            )
+            tail = deque(maxlen=self.tail_lines)
+            jobs = [self.read_stderr(process.stderr, tail), process.wait()]
+            if stdin is not None:
+                jobs.append(self.feed_stdin(process.stdin, stdin))
+            try:
+                await asyncio.wait_for(asyncio.gather(*jobs), self.timeout)
+            except asyncio.TimeoutError:
+                tail.append("转码超时({}s)，已终止进程".format(self.timeout))
+                return None, list(tail)
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+            return process.returncode, list(tail)
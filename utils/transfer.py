@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import os
+import re
+
+from aiohttp import ClientError, ClientResponseError, ClientTimeout
+from yarl import URL
+
+from .dedup import hash_file
+from .metrics import metrics
+from .sink import FileSink, SinkOptions, preallocate
+
+
+class IncompleteDownloadError(ClientError):
+    """
+    已接收的字节数与服务端声明的长度不一致，.part 文件会保留下来用于续传
+    """
+
+
+def make_timeout(timeout):
+    """
+    timeout 作为连接和单次读取的超时，而不是整个下载的总时长，否则大文件永远下载不完
+    """
+    if isinstance(timeout, ClientTimeout):
+        return timeout
+    return ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+
+
+def raise_status(resp):
+    """
+    把不符合预期的响应状态转成 ClientResponseError，由重试策略按状态码分类
+    """
+    raise ClientResponseError(resp.request_info, resp.history, status=resp.status,
+                              message=resp.reason or "", headers=resp.headers)
+
+
+def load_part_meta(meta_file):
+    try:
+        with open(meta_file, mode="r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_part_meta(meta_file, meta):
+    with open(meta_file, mode="w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def remove_part(part):
+    for file in (part, part + ".json"):
+        if os.path.isfile(file):
+            os.remove(file)
+
+
+def discard_part(part):
+    """
+    丢弃 .part 中已下载的数据和进度记录，但保留 .part 文件本身：
+    多进程分配编号文件名时它同时是占位文件（见 FileNoIndex.claim），删掉会让其它进程拿到同一个编号
+    """
+    if os.path.isfile(part):
+        os.truncate(part, 0)
+    if os.path.isfile(part + ".json"):
+        os.remove(part + ".json")
+
+
+def parse_content_range(value):
+    """
+    解析 Content-Range，返回 (start, total)，total 未知时为 None
+    bytes 100-199/1000 -> (100, 1000)；bytes */1000 -> (None, 1000)
+    """
+    m = re.match(r"bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)", value or "")
+    if m is None:
+        return None, None
+    start = int(m.group(1)) if m.group(1) is not None else None
+    total = int(m.group(2)) if m.group(2) != "*" else None
+    return start, total
+
+
+def get_validator(headers):
+    """
+    If-Range 只能使用强 ETag，弱 ETag 时退而使用 Last-Modified
+    """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def feed_part(hasher, part, length=None):
+    """
+    续传前把 .part 中已有的前 length 字节补进摘要
+    """
+    if hasher is not None and os.path.isfile(part):
+        hash_file(part, hasher, length=length)
+
+
+async def fetch_resumable(session, url, filepath, timeout, options=None, hasher=None, flow=None):
+    """
+    断点续传下载：数据先写入 filepath.part，重试时用 Range 请求从断点继续，
+    通过 ETag/Last-Modified 判断远端文件是否变化，字节数与 Content-Length 一致时才原子重命名为 filepath
+    :param options: SinkOptions，读取块大小、写缓冲、预分配和落盘方式
+    :param hasher: hashlib 对象，传入时边下载边计算内容摘要（续传时包含之前已下载的部分）
+    :param flow: bandwidth.Flow，传入时每收到一块都经过带宽调度
+    :return: 响应状态码 200/206，其它状态码抛出 ClientResponseError
+    """
+    options = options or SinkOptions()
+    part = filepath + ".part"
+    meta_file = part + ".json"
+    meta = load_part_meta(meta_file)
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    # 预分配后文件大小不代表已下载的量，以 .part.json 中记录的进度为准
+    offset = min(offset, meta.get("written", offset))
+    if offset and meta.get("url") != url:
+        discard_part(part)
+        offset = 0
+
+    headers = {}
+    if offset:
+        headers["Range"] = "bytes=%d-" % offset
+        if meta.get("validator"):
+            headers["If-Range"] = meta["validator"]
+
+    async with session.request(method="GET", url=URL(url, encoded=True), headers=headers,
+                               timeout=make_timeout(timeout)) as resp:
+        if resp.status == 416 and offset:
+            # 请求的范围超出文件大小：.part 已经完整则直接完成，否则丢弃重下
+            _, total = parse_content_range(resp.headers.get("Content-Range"))
+            if total is not None and total == offset:
+                feed_part(hasher, part, offset)
+                os.truncate(part, offset)
+                os.replace(part, filepath)
+                remove_part(part)
+                return 206
+            discard_part(part)
+            raise IncompleteDownloadError("续传范围无效，已丢弃 .part 文件")
+
+        if resp.status == 206:
+            start, total = parse_content_range(resp.headers.get("Content-Range"))
+            if start != offset:
+                discard_part(part)
+                raise IncompleteDownloadError("续传起点不一致: {}/{}".format(start, offset))
+            feed_part(hasher, part, offset)
+        elif resp.status == 200:
+            # 服务端不支持 Range 或文件已变化，从头开始
+            offset = 0
+            total = resp.content_length
+        else:
+            raise_status(resp)
+
+        meta = {"url": url, "validator": get_validator(resp.headers), "total": total, "written": offset}
+        save_part_meta(meta_file, meta)
+        if flow is not None:
+            flow.sized(total)
+
+        def on_flush(written):
+            meta["written"] = written
+            save_part_meta(meta_file, meta)
+
+        async with FileSink(part, offset=offset, length=total, options=options, truncate=True,
+                            on_flush=on_flush) as sink:
+            async for b in resp.content.iter_chunked(options.chunk_size):
+                if b:
+                    if flow is not None:
+                        await flow.consume(len(b))
+                    metrics.inc("bytes_total", len(b), stage="download")
+                    if hasher is not None:
+                        hasher.update(b)
+                    await sink.write(b)
+
+    size = sink.written
+    if (total is not None and size != total) or size == 0:
+        raise IncompleteDownloadError("已接收 {}/{} 字节".format(size, total))
+    os.replace(part, filepath)
+    remove_part(part)
+    return resp.status
+
+
+async def probe_ranges(session, url, timeout):
+    """
+    探测文件大小以及是否支持 Range：先发 HEAD，HEAD 失败或拿不到长度时再用 bytes=0-0 的 GET 试一次
+    HEAD 返回 200 但没有 Accept-Ranges: bytes 时按不支持处理，不再多发一次 GET
+    :return: (content_length, accept_ranges, validator)
+    """
+    try:
+        async with session.request(method="HEAD", url=URL(url, encoded=True), allow_redirects=True,
+                                   timeout=make_timeout(timeout)) as resp:
+            if resp.status == 200:
+                accept_ranges = resp.headers.get("Accept-Ranges", "").lower() == "bytes"
+                # 支持 Range 但没给长度时才需要用 GET 的 Content-Range 拿到文件大小
+                if resp.content_length or not accept_ranges:
+                    return resp.content_length, accept_ranges, get_validator(resp.headers)
+    except ClientError:
+        pass
+
+    async with session.request(method="GET", url=URL(url, encoded=True), headers={"Range": "bytes=0-0"},
+                               timeout=make_timeout(timeout)) as resp:
+        if resp.status == 206:
+            _, total = parse_content_range(resp.headers.get("Content-Range"))
+            return total, total is not None, get_validator(resp.headers)
+        return resp.content_length, False, get_validator(resp.headers)
+
+
+async def probe_media(session, url, timeout):
+    """
+    探测文件大小和类型：先发 HEAD，拿不到长度时再用 bytes=0-0 的 GET 试一次
+    :return: (content_length, content_type)，长度未知时为 None，请求失败时抛出 ClientResponseError
+    """
+    try:
+        async with session.request(method="HEAD", url=URL(url, encoded=True), allow_redirects=True,
+                                   timeout=make_timeout(timeout)) as resp:
+            if resp.status == 200 and resp.content_length:
+                return resp.content_length, resp.content_type
+    except ClientError:
+        pass
+
+    async with session.request(method="GET", url=URL(url, encoded=True), headers={"Range": "bytes=0-0"},
+                               timeout=make_timeout(timeout)) as resp:
+        if resp.status >= 400:
+            raise_status(resp)
+        if resp.status == 206:
+            _, total = parse_content_range(resp.headers.get("Content-Range"))
+            return total, resp.content_type
+        return resp.content_length, resp.content_type
+
+
+async def fetch_segmented(session, url, filepath, timeout, segments=4, min_segment_size=8 * 1024 * 1024,
+                          options=None, hasher=None, flow=None):
+    """
+    多连接分段下载：探测到文件支持 Range 时，把文件按字节区间切成多段并行下载，
+    预分配 .part 文件后按偏移写入，已完成的分段记录在 .part.json 中，重试时跳过
+    不支持 Range、文件太小或分段数 <= 1 时退回单连接的 fetch_resumable
+    :param options: SinkOptions，每个分段各自用一个 FileSink 按偏移写入
+    :param hasher: hashlib 对象，分段是乱序写入的，所以在全部完成后读一遍文件计算摘要
+    :param flow: bandwidth.Flow，所有分段共用，整个文件只占一份带宽
+    :return: 响应状态码 200/206，其它状态码抛出 ClientResponseError
+    """
+    options = options or SinkOptions()
+    part = filepath + ".part"
+    meta_file = part + ".json"
+    meta = load_part_meta(meta_file)
+    if os.path.isfile(part) and meta.get("url") == url and "done" not in meta:
+        # 上一次是单连接下载的，继续续传
+        return await fetch_resumable(session, url, filepath, timeout, options, hasher, flow)
+    if segments <= 1 or not hasattr(os, "pwrite"):
+        return await fetch_resumable(session, url, filepath, timeout, options, hasher, flow)
+
+    length, accept_ranges, validator = await probe_ranges(session, url, timeout)
+    if not accept_ranges or length is None or length < min_segment_size * 2:
+        return await fetch_resumable(session, url, filepath, timeout, options, hasher, flow)
+
+    if flow is not None:
+        flow.sized(length)
+    count = min(segments, length // min_segment_size)
+    size = -(-length // count)
+    bounds = [(start, min(start + size, length) - 1) for start in range(0, length, size)]
+
+    if os.path.isfile(part) and os.path.getsize(part) == length and meta.get("url") == url and \
+            meta.get("validator") == validator and meta.get("total") == length and meta.get("size") == size:
+        done = set(meta["done"])
+    else:
+        discard_part(part)
+        done = set()
+    meta = {"url": url, "validator": validator, "total": length, "size": size, "done": sorted(done)}
+    save_part_meta(meta_file, meta)
+
+    loop = asyncio.get_running_loop()
+    if not done:
+        fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # 各分段按偏移写入，文件需要先达到完整大小
+            if options.preallocate:
+                preallocate(fd, length)
+            else:
+                os.ftruncate(fd, length)
+        finally:
+            os.close(fd)
+
+    async def fetch_one(start, end):
+        headers = {"Range": "bytes=%d-%d" % (start, end)}
+        if validator:
+            headers["If-Range"] = validator
+        async with session.request(method="GET", url=URL(url, encoded=True), headers=headers,
+                                   timeout=make_timeout(timeout)) as resp:
+            if resp.status >= 400:
+                raise_status(resp)
+            if resp.status != 206:
+                raise IncompleteDownloadError("分段请求未返回 206: {}".format(resp.status))
+            async with FileSink(part, offset=start, options=options) as sink:
+                async for b in resp.content.iter_chunked(options.chunk_size):
+                    if b:
+                        if flow is not None:
+                            await flow.consume(len(b))
+                        metrics.inc("bytes_total", len(b), stage="download")
+                        await sink.write(b)
+        if sink.written != end + 1:
+            raise IncompleteDownloadError("分段 {}-{} 已接收 {} 字节".format(start, end, sink.written - start))
+        done.add(start)
+        meta["done"] = sorted(done)
+        save_part_meta(meta_file, meta)
+
+    results = await asyncio.gather(*(fetch_one(start, end) for start, end in bounds if start not in done),
+                                   return_exceptions=True)
+
+    for ret in results:
+        if isinstance(ret, BaseException):
+            raise ret
+    if hasher is not None:
+        await loop.run_in_executor(None, feed_part, hasher, part)
+    os.replace(part, filepath)
+    remove_part(part)
+    return 206
@@ -5,13 +5,19 @@
 # @Project: douyin_spider
 # @File: common
 import configparser
-import chardet
 import os
 import re
-import traceback
+import sys
+
+from .file_index import FileNoIndex
 
 
 class Utils:
+    # 编号文件名的分配索引，整个进程共用
+    file_no_index = FileNoIndex()
+    # 已读取的配置文件，整个进程共用
+    _config_cache = {}
+
     # 获取当前路径
     @classmethod
     def get_current_path(cls, filepath: tuple[str, ...], filename=None):
@@ -31,46 +37,47 @@ class Utils:
         return curr
 
     @classmethod
-    def read_config(cls, filepath: tuple[str, ...], filename, encoding=None):
+    def read_config(cls, filepath: tuple[str, ...], filename, encoding=None, reload=False):
         """
-        读取配置文件
+        读取配置文件，同一个文件在进程内只解析一次
+        未指定编码时先按 UTF-8 读取，解码失败才用 chardet 检测编码
+        :param reload: 为 True 时忽略缓存重新读取
         :return:
         """
-        if encoding is None:
-            ecod = cls.detect_file_encoding(filepath, filename)
-            if ecod is None:
-                print("获取文件编码失败，文件不存在")
-                return ecod
-        else:
-            ecod = encoding
-            print("指定文件编码格式：{}".format(ecod))
         file = cls.get_current_path(filepath, filename)
-        conf = configparser.RawConfigParser()
+        key = (file, encoding)
+        if not reload and key in cls._config_cache:
+            return cls._config_cache[key]
 
+        if not os.path.isfile(file):
+            print("获取文件编码失败，文件不存在")
+            return None
+        if encoding is not None:
+            print("指定文件编码格式：{}".format(encoding))
+
+        conf = configparser.RawConfigParser()
         try:
-            conf.read(file, encoding=ecod)
-            return conf
+            conf.read(file, encoding=encoding or "utf-8-sig")
         except UnicodeDecodeError:
             ecod = cls.detect_file_encoding(filepath, filename, is_full=True)
+            conf = configparser.RawConfigParser()
             conf.read(file, encoding=ecod)
-            return conf
         except Exception as e:
             print(e)
             return None
+        cls._config_cache[key] = conf
+        return conf
 
     @classmethod
     def read_file(cls, filepath: tuple[str, ...], filename, encoding=None):
-        if encoding is None:
-            ecod = cls.detect_file_encoding(filepath, filename)
-            if ecod is None:
-                print("获取文件编码失败，文件不存在")
-                return ecod
-        else:
-            ecod = encoding
-            print("指定文件编码格式：{}".format(ecod))
         file = cls.get_current_path(filepath, filename)
+        if not os.path.isfile(file):
+            print("获取文件编码失败，文件不存在")
+            return None
+        if encoding is not None:
+            print("指定文件编码格式：{}".format(encoding))
         try:
-            with open(file, mode="r", encoding=ecod) as f:
+            with open(file, mode="r", encoding=encoding or "utf-8-sig") as f:
                 data = f.read()
             return data
         except UnicodeDecodeError:
@@ -79,6 +86,73 @@ class Utils:
                 data = f.read()
             return data
 
+    @staticmethod
+    def iter_urls(sources):
+        """
+        按行惰性读取链接，sources 中每一项可以是 txt 文件、"-"（标准输入）或包含若干 txt 文件的目录
+        """
+        for source in sources:
+            if source == "-":
+                files = [None]
+            elif os.path.isdir(source):
+                files = sorted(f.path for f in os.scandir(source) if f.is_file() and f.name.endswith(".txt"))
+            else:
+                files = [source]
+
+            for file in files:
+                try:
+                    f = sys.stdin if file is None else open(file, mode="r", encoding="utf-8")
+                    with f:
+                        for line in f:
+                            line = line.strip()
+                            if line:
+                                yield line
+                except Exception as e:
+                    print(f"读取文件失败: {e}")
+
+    @classmethod
+    async def aiter_urls(cls, sources, maxsize=1000):
+        """
+        iter_urls 的异步版本：在后台线程中逐行读取，通过有界队列交给事件循环
+        标准输入的上游可能很久才写一行（cron 包装脚本、tail -f），读取时不能卡住正在进行的下载、退避和限速计时
+        """
+        import asyncio  # 只有在事件循环中读取链接时才用得到
+        import threading
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=maxsize)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            try:
+                asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+            except (RuntimeError, asyncio.CancelledError):
+                # 事件循环已经关闭
+                stop.set()
+
+        def read():
+            for url in cls.iter_urls(sources):
+                if stop.is_set():
+                    return
+                put(url)
+            if not stop.is_set():
+                put(end)
+
+        # 守护线程：阻塞在标准输入上时不妨碍进程退出
+        threading.Thread(target=read, name="read-urls", daemon=True).start()
+        try:
+            while True:
+                url = await queue.get()
+                if url is end:
+                    return
+                yield url
+        finally:
+            stop.set()
+            # 取空队列，让阻塞在 put 上的读取线程看到 stop 后退出
+            while not queue.empty():
+                queue.get_nowait()
+
     @classmethod
     def folders_create(cls, filepath: tuple[str, ...]):
         """
@@ -87,7 +161,8 @@ class Utils:
         """
         path = cls.get_current_path(filepath=filepath)
         if not os.path.exists(path):
-            os.makedirs(path)
+            # 多进程同时创建同一个目录时不报错
+            os.makedirs(path, exist_ok=True)
             # log.info("创建目录：{}".format(path))
             print("创建目录：{}".format(path))
 
@@ -101,8 +176,7 @@ class Utils:
         :param filepath:
         :return:
         """
-        stack = traceback.extract_stack()
-        caller = stack[-2]  # 上一层栈帧
+        import chardet  # 只有 UTF-8 解码失败时才用得到，按需导入
 
         file = cls.get_current_path(filepath, filename)
         if not os.path.isfile(file):
@@ -113,10 +187,10 @@ class Utils:
         with open(file, mode="rb") as f:
             # raw_data = f.read() # 这种效率有点慢，对于大文件时
             if is_full:
-                print("读取全部文件获取编码:{}".format(caller))
+                print("读取全部文件获取编码:{}".format(file))
                 raw_data = f.read()
             else:
-                print("按部分文件获取编码:{}".format(caller))
+                print("按部分文件获取编码:{}".format(file))
                 raw_data = f.read()[0:10240]  # 只截取一部分
             result = chardet.detect(raw_data)
             return result["encoding"]
@@ -128,40 +202,26 @@ class Utils:
             new_str = new_str[0:31]
         return new_str
 
-    def get_file_no3(self, filepath: tuple[str, ...], filename, fno: int):
+    def get_file_no3(self, filepath: tuple[str, ...], filename, fno: int, owner=None, held=()):
         """
         按文件名来统一编号：
         file1_00001、file1_00002
         file2_00001、file2_00002
+        返回的编号会被预留，再次调用不会分配到同一个文件名
+        :param owner: 占用者（链接），见 FileNoIndex.reserve
+        :param held: 额外视为已占用的完整路径
         """
-        if not os.path.exists(self.get_current_path(filepath)):
+        path = self.get_current_path(filepath)
+        if not os.path.exists(path):
             print("目录不存在~")
             return None
 
         file_ext = os.path.splitext(filename)
         if file_ext[1] in ("", "."):
             print("Warning: filename-->", filename)  # 文件名可能不符合规范，需要注意一下
-        no1 = re.search("_([0-9]{5})$", file_ext[0])  # 获取文件原先的编号
-        if no1 is None:
-            file_no_ext = file_ext[0]
-        else:
-            # 如果文件存在符合规范的编号，且不在文件中存在，直接返回
-            file = self.get_current_path(filepath, filename)
-            if not os.path.isfile(file):
-                return {"file": filename, "fno": fno}
-
-            file_no_ext = file_ext[0][:-6]
 
-        files = (f.name for f in os.scandir(self.get_current_path(filepath)) if f.is_file())
-        files_count = sum(1 for f in os.scandir(self.get_current_path(filepath)) if f.is_file())
-
-        for fno in range(1, files_count + 2):
-            file = file_no_ext + "_%05d" % fno + file_ext[1]
-            if file not in files:
-                return {"file": file, "fno": fno}
-        else:
-            print("匹配失败~")
-            return None
+        file, fno = self.file_no_index.reserve(path, filename, owner, held)
+        return {"file": file, "fno": fno}
 
     @staticmethod
     def truncate_string(s: str, max_length: int):